@@ -0,0 +1,26 @@
+# Gunicorn settings for the sign in app.
+#
+# GUNICORN_WORKER_CLASS selects the deployment mode:
+#   sync   - the default, one request per worker at a time
+#   gevent - cooperative workers, so slow Kanboard responses and held-open kiosk
+#            connections don't starve the scan endpoint
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8100")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+# Only used by the gevent worker: concurrent requests per worker
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "100"))
+# Long-polling kiosks hold a request open for up to KIOSK_WAIT_TIMEOUT seconds
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+
+
+def post_fork(server, worker):
+    if worker_class != "gevent":
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    # Make psycopg2 yield to other greenlets while waiting on PostgreSQL
+    patch_psycopg()
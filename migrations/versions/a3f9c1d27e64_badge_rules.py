@@ -0,0 +1,64 @@
+"""Badge rules
+
+Revision ID: a3f9c1d27e64
+Revises: e5a4d2c7b913
+Create Date: 2026-10-19 15:02:37.418290
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a3f9c1d27e64"
+down_revision = "e5a4d2c7b913"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "badge_rules",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("badge_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "kind",
+            sa.Enum("Hours", "Events", "Subteam", "Badge", name="rulekind"),
+            nullable=False,
+        ),
+        sa.Column("threshold", sa.Integer(), nullable=False),
+        sa.Column("event_type_id", sa.Integer(), nullable=True),
+        sa.Column("current_year", sa.Boolean(), nullable=False),
+        sa.Column("subteam_id", sa.Integer(), nullable=True),
+        sa.Column("required_badge_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["badge_id"],
+            ["badges.id"],
+            name=op.f("fk_badge_rules_badge_id_badges"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["event_type_id"],
+            ["event_types.id"],
+            name=op.f("fk_badge_rules_event_type_id_event_types"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["required_badge_id"],
+            ["badges.id"],
+            name=op.f("fk_badge_rules_required_badge_id_badges"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["subteam_id"],
+            ["subteams.id"],
+            name=op.f("fk_badge_rules_subteam_id_subteams"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_badge_rules")),
+    )
+
+
+def downgrade():
+    op.drop_table("badge_rules")
+    sa.Enum(name="rulekind").drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,39 @@
+"""Guardian indexes
+
+Revision ID: b61e8d4f2a95
+Revises: a3f9c1d27e64
+Create Date: 2026-10-19 16:21:08.730512
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b61e8d4f2a95"
+down_revision = "a3f9c1d27e64"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("parent_child_association", schema=None) as batch_op:
+        batch_op.create_index(
+            batch_op.f("ix_parent_child_association_user_id"), ["user_id"], unique=False
+        )
+
+    with op.batch_alter_table("guardians", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_guardians_user_id"), ["user_id"], unique=False)
+
+    with op.batch_alter_table("students", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_students_user_id"), ["user_id"], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table("students", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_students_user_id"))
+
+    with op.batch_alter_table("guardians", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_guardians_user_id"))
+
+    with op.batch_alter_table("parent_child_association", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_parent_child_association_user_id"))
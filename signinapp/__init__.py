@@ -1,51 +1,40 @@
 #!/usr/bin/env python
 
-import datetime
+import importlib
 import locale
 import os
 import zoneinfo
+from collections.abc import Mapping
 
-import flask_excel as excel
 import yaml
-from flask import Flask, render_template
-from flask_assets import Bundle, Environment
-from flask_bootstrap import Bootstrap5
-from flask_migrate import Migrate
-from sqlalchemy.future import select
-
-from . import (
-    active,
-    admin,
-    auth,
-    badge,
-    dbadmin,
-    event,
-    events,
-    finance,
-    proxy,
-    qr,
-    search,
-    team,
-    user,
-)
-from .auth import login_manager
-from .jobs import scheduler
-from .model import (
-    Active,
-    Badge,
-    Event,
-    EventType,
-    Guardian,
-    Role,
-    Student,
-    Subteam,
-    User,
-    db,
-)
-
-locale.setlocale(locale.LC_ALL, "")
-
-app = Flask(__name__)
+from flask import Flask
+
+# Feature modules with an init_app(app) hook, imported when the app is created
+# so that importing the package itself stays cheap
+BLUEPRINTS = [
+    "assets",
+    "changes",
+    "choices",
+    "main",
+    "active",
+    "admin",
+    "analytics",
+    "auth",
+    "badge",
+    "dbadmin",
+    "event",
+    "events",
+    "finance",
+    "fragments",
+    "passwords",
+    "proxy",
+    "qr",
+    "rules",
+    "search",
+    "team",
+    "user",
+    "cli",
+]
 
 
 class Config:
@@ -56,12 +45,49 @@ We are Merrimack High School FIRST Robotics Competition Team 166, Chop Shop, \
 Our mission is to build teamwork and a great robot, along with fostering a love for \
     Science, Technology, Engineering, and Mathematics.""".strip()
     DB_NAME = "signin.db"
+    DB_PROFILE = "auto"  # Valid Options (auto, none, sqlite, postgresql)
+    DB_PROFILE_SETTINGS = {}  # Overrides for the profile, see database.py
+    # Optional database for the report pages, e.g. a PostgreSQL replica or
+    # sqlite:///file:/appdata/signin.db?mode=ro&uri=true
+    READ_REPLICA_URI = None
     TIME_ZONE = "America/New_York"
     SECRET_KEY = "1234"
     PRE_EVENT_ACTIVE_TIME = 30
     POST_EVENT_ACTIVE_TIME = 120
     AUTO_SIGNOUT_BEHAVIOR = "None"  # Valid Options (Credit, Discard, None)
     PROXY_URL = "http://localhost:8080/kanboard/"
+    PROXY_POOL_SIZE = 10
+    PROXY_CONNECT_TIMEOUT = 5
+    PROXY_READ_TIMEOUT = 60
+    PROXY_CACHE_MAX_SIZE = 5 * 1024 * 1024
+    KIOSK_WAIT_TIMEOUT = 25
+    KIOSK_WAIT_INTERVAL = 1
+    # Repeat scans of a user within this many seconds are ignored
+    SCAN_DEBOUNCE_SECONDS = 5
+    # Let users sign into an event while signed into another, counting the time twice
+    ALLOW_OVERLAPPING_SIGNINS = False
+    # Minutes per slot of the event occupancy timeline
+    OCCUPANCY_RESOLUTION = 15
+    # How committed changes reach the other workers' caches, see changes.py
+    CHANGE_TRANSPORT = "auto"  # Valid Options (auto, none, notify, file)
+    CHANGE_POLL_INTERVAL = 0.5
+    # Form select lists are reloaded after this many seconds even without a change
+    FORM_CHOICES_TTL = 60
+    # Cache for {% cache %} blocks in templates, see fragments.py
+    FRAGMENT_CACHE = "memory"  # Valid Options (none, memory, filesystem)
+    FRAGMENT_CACHE_SIZE = 1024
+    FRAGMENT_CACHE_TTL = 600
+    # werkzeug method for new password hashes, with all of its cost parameters.
+    # Users are rehashed when they next log in after it changes, see `flask bench logins`
+    PASSWORD_METHOD = "scrypt:32768:8:1"
+    # Passwords hashed at once by each worker, 0 for one per CPU, and how many more may wait
+    PASSWORD_WORKERS = 0
+    PASSWORD_QUEUE = 32
+    # Only the server entry point (webapp.py) runs the background jobs and creates tables
+    SCHEDULER_ENABLED = False
+    CREATE_ALL = False
+    # Flask-Migrate pulls in alembic, which only the `flask db` commands need
+    MIGRATE_ENABLED = True
 
 
 class DebugConfig(Config):
@@ -69,122 +95,138 @@ class DebugConfig(Config):
     DB_NAME = ":memory:"
 
 
-# First load the default config...
-if app.config["DEBUG"]:
-    app.config.from_object(DebugConfig)
-else:
-    app.config.from_object(Config)
-# ...then load the config file if it exists...
-rv = os.environ.get("CSSIGNIN_CONFIG")
-if rv:
-    app.config.from_file(rv, load=yaml.safe_load, silent=True)
-# ...then load from environment variables
-app.config.from_prefixed_env()
-
-# Now validate the config
-assert app.config["TITLE"], "Invalid title given in config"
-assert (
-    app.config["TIME_ZONE"] in zoneinfo.available_timezones()
-), "Invalid time zone given in config"
-assert app.config["PRE_EVENT_ACTIVE_TIME"] >= 0, "Invalid pre active time given in config"
-assert app.config["POST_EVENT_ACTIVE_TIME"] >= 0, "Invalid post active time given in config"
-assert app.config["AUTO_SIGNOUT_BEHAVIOR"] in (
-    "Credit",
-    "Discard",
-    "None",
-), "Invalid sign out behavior given in config"
-
-app.config.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite:///" + app.config["DB_NAME"])
-app.config.setdefault("SQLALCHEMY_TRACK_MODIFICATIONS", True)
-
-scss = Bundle(
-    "custom.scss",
-    filters="libsass,cssmin",
-    depends="scss/*.scss",
-    output="custom.generated.css",
-)
-assets = Environment(app)
-assets.register("custom_css", scss)
-
-excel.init_excel(app)
-
-bootstrap = Bootstrap5(app)
-
-login_manager.login_view = "auth.login"
-login_manager.init_app(app)
-
-db.init_app(app)
-with app.app_context():
-    db.create_all()
-
-migrate = Migrate(app, db)
-
-scheduler.init_app(app)
-scheduler.start()
-
-active.init_app(app)
-admin.init_app(app)
-auth.init_app(app)
-badge.init_app(app)
-dbadmin.init_app(app)
-event.init_app(app)
-events.init_app(app)
-finance.init_app(app)
-proxy.init_app(app)
-qr.init_app(app)
-search.init_app(app)
-team.init_app(app)
-user.init_app(app)
-
-
-@app.route("/")
-def index():
-    stmt = select(Event).filter_by(is_active=True)
-    events = db.session.scalars(stmt)
-    return render_template("index.html.jinja2", events=events)
-
-
-@app.errorhandler(404)
-def page_not_found(e):
-    return (
-        render_template("error.html.jinja2", error_headline="Page Not Found", error_msg=e),
-        404,
+def validate_config(config: Mapping):
+    assert config["TITLE"], "Invalid title given in config"
+    assert config["TIME_ZONE"] in zoneinfo.available_timezones(), (
+        "Invalid time zone given in config"
     )
+    assert config["PRE_EVENT_ACTIVE_TIME"] >= 0, "Invalid pre active time given in config"
+    assert config["POST_EVENT_ACTIVE_TIME"] >= 0, "Invalid post active time given in config"
+    assert config["AUTO_SIGNOUT_BEHAVIOR"] in (
+        "Credit",
+        "Discard",
+        "None",
+    ), "Invalid sign out behavior given in config"
+    assert config["PROXY_POOL_SIZE"] > 0, "Invalid proxy pool size given in config"
+    assert config["PROXY_CONNECT_TIMEOUT"] > 0, "Invalid proxy connect timeout given in config"
+    assert config["PROXY_READ_TIMEOUT"] > 0, "Invalid proxy read timeout given in config"
+    assert config["KIOSK_WAIT_TIMEOUT"] >= 0, "Invalid kiosk wait timeout given in config"
+    assert config["KIOSK_WAIT_INTERVAL"] > 0, "Invalid kiosk wait interval given in config"
+    assert config["SCAN_DEBOUNCE_SECONDS"] >= 0, "Invalid scan debounce given in config"
+    assert 1 <= config["OCCUPANCY_RESOLUTION"] <= 24 * 60, (
+        "Invalid occupancy resolution given in config"
+    )
+    assert config["CHANGE_TRANSPORT"] in (
+        "auto",
+        "none",
+        "notify",
+        "file",
+    ), "Invalid change transport given in config"
+    assert config["CHANGE_POLL_INTERVAL"] > 0, "Invalid change poll interval given in config"
+    assert config["FORM_CHOICES_TTL"] >= 0, "Invalid form choices TTL given in config"
+    assert config["FRAGMENT_CACHE"] in (
+        "none",
+        "memory",
+        "filesystem",
+    ), "Invalid fragment cache given in config"
+    assert config["FRAGMENT_CACHE_SIZE"] > 0, "Invalid fragment cache size given in config"
+    assert config["FRAGMENT_CACHE_TTL"] > 0, "Invalid fragment cache TTL given in config"
+    assert config["PASSWORD_WORKERS"] >= 0, "Invalid password workers given in config"
+    assert config["PASSWORD_QUEUE"] >= 0, "Invalid password queue given in config"
+
+    from .database import validate_profile
+    from .passwords import METHOD_RE
+
+    assert METHOD_RE.fullmatch(config["PASSWORD_METHOD"]), "Invalid password method given in config"
+
+    validate_profile(config)
+
+
+def create_app(config: Mapping | object | None = None) -> Flask:
+    """Create and configure the application.
+
+    Settings are loaded from the defaults, then the CSSIGNIN_CONFIG file, then
+    FLASK_* environment variables, and finally `config` if one is given.
+    """
+    locale.setlocale(locale.LC_ALL, "")
+
+    app = Flask(__name__)
+
+    # First load the default config...
+    if app.config["DEBUG"]:
+        app.config.from_object(DebugConfig)
+    else:
+        app.config.from_object(Config)
+    # ...then load the config file if it exists...
+    rv = os.environ.get("CSSIGNIN_CONFIG")
+    if rv:
+        app.config.from_file(rv, load=yaml.safe_load, silent=True)
+    # ...then load from environment variables...
+    app.config.from_prefixed_env()
+    # ...then any explicit overrides
+    if isinstance(config, Mapping):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    app.config.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite:///" + app.config["DB_NAME"])
+    app.config.setdefault("SQLALCHEMY_TRACK_MODIFICATIONS", True)
+
+    # Now validate the config
+    validate_config(app.config)
+
+    import flask_excel as excel
+    from flask_bootstrap import Bootstrap5
+
+    from . import database
+    from .auth import login_manager
+    from .model import db
+
+    excel.init_excel(app)
+
+    Bootstrap5(app)
+
+    login_manager.login_view = "auth.login"
+    login_manager.init_app(app)
+
+    database.init_app(app)
+    db.init_app(app)
+    with app.app_context():
+        database.init_engines(app, db.engines)
+    if app.config["MIGRATE_ENABLED"]:
+        from flask_migrate import Migrate
 
+        Migrate(app, db)
 
-@app.errorhandler(500)
-def internal_server_error(e: int):
-    return (
-        render_template("error.html.jinja2", error_headline="Internal Error", error_msg=e),
-        500,
-    )
+    for name in BLUEPRINTS:
+        importlib.import_module(f".{name}", __name__).init_app(app)
 
+    if app.config["CREATE_ALL"]:
+        with app.app_context():
+            db.create_all()
+            if app.config["DEBUG"]:
+                init_default_db()
+                init_debug_db()
 
-@app.errorhandler(Exception)
-def internal_server_error_ex(e: Exception):
-    import io
-    import traceback
+    if app.config["SCHEDULER_ENABLED"]:
+        from . import jobs
 
-    buffer = io.StringIO()
+        jobs.init_app(app)
 
-    traceback.print_exception(e)
-    traceback.print_exception(e, file=buffer)
-    return (
-        render_template(
-            "error.html.jinja2",
-            error_headline="Internal Error",
-            error_msg=buffer.getvalue(),
-        ),
-    )
+    return app
 
 
 def create_if_not_exists(cls, name, **kwargs):
+    from .model import db
+
     if not cls.from_name(name):
         item = cls(name=name, **kwargs)
         db.session.add(item)
 
 
 def init_default_db():
+    from .model import EventType, Role, Subteam, User, db
+
     create_if_not_exists(Role, name="admin", mentor=True, can_display=True, admin=True)
     create_if_not_exists(Role, name="mentor", mentor=True, can_display=True)
     create_if_not_exists(Role, name="display", can_display=True, autoload=True)
@@ -225,87 +267,91 @@ def init_default_db():
     db.session.commit()
 
 
-if app.config["DEBUG"]:
-    with app.app_context():
-        init_default_db()
-
-        now = datetime.datetime.now(tz=datetime.UTC).replace(microsecond=0)
-        offset = datetime.timedelta(hours=3)
-        training = Event.create(
-            name="Training",
-            description="Test Training Event",
-            location="D124",
-            code="5678",
-            start=now,
-            end=now + offset,
-            event_type="Training",
-        )
-        notTraining = Event.create(
-            name="Not Training",
-            description="Test Build Event",
-            location="D124",
-            code="5679",
-            start=now,
-            end=now + offset,
-            event_type="Build",
-        )
+def init_debug_db():
+    "Add sample events and users for the debug server"
+    import datetime
 
-        expired_event = Event.create(
-            name="Ended Training",
-            description="Test Training Event",
-            location="D124",
-            code="8765",
-            start=now - offset,
-            end=now - datetime.timedelta(minutes=app.config["POST_EVENT_ACTIVE_TIME"] - 5),
-            event_type="Build",
-        )
-        db.session.commit()
-
-        mentor_user = User.make(
-            "msoucy@signin.chopshoplib.info",
-            "Matt Soucy",
-            preferred_name="Matt",
-            code="code-msoucy",
-            phone_number="603 555-5555",
-            address="123 First Street",
-            tshirt_size="Large",
-            password="1234",
-            role="mentor",
-            approved=True,
-        )
-        student_user = Student.make(
-            "Jburke@signin.chopshoplib.info",
-            "Jeff Burke",
-            preferred_name="Jeff",
-            code="code-jburke",
-            password="1234",
-            graduation_year=2022,
-            subteam="Software",
-            approved=True,
-            tshirt_size="Large",
-        )
-        student_user.student_user_data.add_guardian(
-            guardian=Guardian.get_from(
-                name="Parent Burke",
-                phone_number="(603)555-5555",
-                email="pburke@signin.chopshoplib.info",
-                contact_order=1,
-            )
-        )
+    from flask import current_app
 
-        student_training_event = Active(
-            user_id=student_user.id, event_id=expired_event.id, start=now - offset
-        )
-        db.session.add(student_training_event)
+    from .model import Active, Badge, Event, Guardian, Student, User, db
+
+    now = datetime.datetime.now(tz=datetime.UTC).replace(microsecond=0)
+    offset = datetime.timedelta(hours=3)
+    Event.create(
+        name="Training",
+        description="Test Training Event",
+        location="D124",
+        code="5678",
+        start=now,
+        end=now + offset,
+        event_type="Training",
+    )
+    Event.create(
+        name="Not Training",
+        description="Test Build Event",
+        location="D124",
+        code="5679",
+        start=now,
+        end=now + offset,
+        event_type="Build",
+    )
 
-        safe = Badge(
-            name="Safety Certified",
-            icon="cone-striped",
-            color="#FFA500",  # Orange - needs to be in hex format for WTForms
-            description="Passed Safety Training",
+    expired_event = Event.create(
+        name="Ended Training",
+        description="Test Training Event",
+        location="D124",
+        code="8765",
+        start=now - offset,
+        end=now - datetime.timedelta(minutes=current_app.config["POST_EVENT_ACTIVE_TIME"] - 5),
+        event_type="Build",
+    )
+    db.session.commit()
+
+    mentor_user = User.make(
+        "msoucy@signin.chopshoplib.info",
+        "Matt Soucy",
+        preferred_name="Matt",
+        code="code-msoucy",
+        phone_number="603 555-5555",
+        address="123 First Street",
+        tshirt_size="Large",
+        password="1234",
+        role="mentor",
+        approved=True,
+    )
+    student_user = Student.make(
+        "Jburke@signin.chopshoplib.info",
+        "Jeff Burke",
+        preferred_name="Jeff",
+        code="code-jburke",
+        password="1234",
+        graduation_year=2022,
+        subteam="Software",
+        approved=True,
+        tshirt_size="Large",
+    )
+    student_user.student_user_data.add_guardian(
+        guardian=Guardian.get_from(
+            name="Parent Burke",
+            phone_number="(603)555-5555",
+            email="pburke@signin.chopshoplib.info",
+            contact_order=1,
         )
-        db.session.add(safe)
-        db.session.commit()
+    )
+
+    student_training_event = Active(
+        user_id=student_user.id, event_id=expired_event.id, start=now - offset
+    )
+    db.session.add(student_training_event)
 
-        mentor_user.award_badge(safe)
-        db.session.commit()
+    safe = Badge(
+        name="Safety Certified",
+        icon="cone-striped",
+        color="#FFA500",  # Orange - needs to be in hex format for WTForms
+        description="Passed Safety Training",
+    )
+    db.session.add(safe)
+    db.session.commit()
+
+    mentor_user.award_badge(safe)
+    db.session.commit()
@@ -3,7 +3,7 @@ from flask.templating import render_template
 from sqlalchemy import delete
 from sqlalchemy.future import select
 
-from .model import Active, Stamps, db
+from .model import Active, db
 from .util import admin_required, mentor_required
 
 bp = Blueprint("active", __name__, url_prefix="/active")
@@ -20,10 +20,7 @@ def view():
 @mentor_required
 def post():
     active_event = db.session.get(Active, request.form["active_id"])
-    stamp = Stamps(user=active_event.user, event=active_event.event, start=active_event.start)
-    db.session.delete(active_event)
-    db.session.add(stamp)
-    db.session.commit()
+    active_event.convert_to_stamp()
     return redirect(url_for("active.view"))
 
 
@@ -1,12 +1,17 @@
+import io
+
 from flask import flash, redirect, request, url_for
 from flask.templating import render_template
 from flask_wtf import FlaskForm
-from werkzeug.security import generate_password_hash
-from wtforms import FormField, StringField, SubmitField
+from flask_wtf.file import FileAllowed, FileField, FileRequired
+from sqlalchemy.future import select
+from wtforms import BooleanField, FormField, StringField, SubmitField
 from wtforms.validators import DataRequired, EqualTo
 
 from ..forms import GuardianDataForm, StudentDataForm, UserForm
-from ..model import Pronoun, Role, ShirtSizes, User, db
+from ..model import Pronoun, Role, ShirtSizes, Student, User, db
+from ..passwords import hash_password
+from ..roster import import_roster
 from ..util import admin_required
 from .util import admin
 
@@ -30,6 +35,40 @@ class DeleteUserForm(FlaskForm):
     submit = SubmitField()
 
 
+class ImportRosterForm(FlaskForm):
+    file = FileField(
+        "Roster",
+        validators=[FileRequired(), FileAllowed(["csv"], "Upload a CSV file")],
+        description="See flask import-roster --help for the columns",
+    )
+    dry_run = BooleanField("Only Check the File")
+    submit = SubmitField("Import")
+
+
+@admin.route("/admin/users/import", methods=["GET", "POST"])
+@admin_required
+def import_users():
+    form = ImportRosterForm()
+    if form.validate_on_submit():
+        result = import_roster(
+            io.TextIOWrapper(form.file.data.stream, encoding="utf-8-sig"), form.dry_run.data
+        )
+        for error in result.errors:
+            flash(error)
+        if result.skipped:
+            flash(f"Skipped users who already have accounts: {', '.join(result.skipped)}")
+        if result.errors or form.dry_run.data:
+            db.session.rollback()
+            if not result.errors:
+                flash(f"The roster would create {result.summary()}")
+        else:
+            db.session.commit()
+            flash(f"Created {result.summary()}")
+            return redirect(url_for("admin.import_users"))
+
+    return render_template("form.html.jinja2", form=form, title="Import Roster")
+
+
 @admin.route("/admin/users/approve", methods=["POST"])
 @admin_required
 def user_approve():
@@ -66,7 +105,7 @@ def user_promote():
         user.email = form.email.data
         user.name = form.name.data
         if form.password.data:
-            user.password = generate_password_hash(form.password.data)
+            user.password = hash_password(form.password.data)
         user.role = Role.from_name("guardian")
         user.preferred_name = form.preferred_name.data
         user.phone_number = form.phone_number.data
@@ -103,7 +142,7 @@ def edit_user():
         user.email = form.email.data
         user.name = form.name.data
         if form.password.data:
-            user.password = generate_password_hash(form.password.data)
+            user.password = hash_password(form.password.data)
         user.role_id = form.admin_data.role.data
         user.subteam_id = form.subteam.data or None
         user.approved = form.admin_data.approved.data
@@ -171,11 +210,10 @@ def edit_guardian_data():
     form = EditGuardianDataForm(obj=user)
 
     if form.validate_on_submit():
-        user.guardian_user_data.students = [
-            db.session.get(User, s).student_user_data
-            for s in form.guardian_data.data["student"]
-            if s and s != "0"
-        ]
+        student_ids = [int(s) for s in form.guardian_data.data["student"] if s and s != "0"]
+        user.guardian_user_data.students = list(
+            db.session.scalars(select(Student).where(Student.user_id.in_(student_ids)))
+        )
 
         db.session.commit()
         return redirect(url_for("team.list_guardians"))
@@ -183,7 +221,7 @@ def edit_guardian_data():
     nested = form.guardian_data.form
     nested.contact_order.process_data(user.guardian_user_data.contact_order)
     for s in user.guardian_user_data.students:
-        nested.student.append_entry(s.user.id)
+        nested.student.append_entry(s.user_id)
     # One more entry in case we're adding students
     nested.student.append_entry()
 
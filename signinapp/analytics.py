@@ -0,0 +1,230 @@
+import threading
+from datetime import MAXYEAR, MINYEAR, date, datetime, timedelta
+from http import HTTPStatus
+
+import numpy as np
+from flask import Blueprint, Flask, Response, current_app, jsonify, request
+from flask.templating import render_template
+from sqlalchemy.future import select
+
+from .changes import changed_tables, subscribe
+from .database import read_replica
+from .model import Event, Stamps, Student, User, db, school_year_for_date
+from .util import correct_time_from_storage, mentor_required
+
+analytics = Blueprint("analytics", __name__, url_prefix="/analytics")
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+# Weeks of attendance the student trends are fitted to
+TREND_WEEKS = 8
+# Changes to these tables make the cached summaries stale
+TABLES = {"stamps", "events", "users", "students"}
+
+
+def season_start(year: int) -> date:
+    "First day of a school year"
+    return date(year - 1, 7, 1)
+
+
+def load_grid(year: int) -> tuple[np.ndarray, list[tuple[int, str, bool]]]:
+    """Seconds each user was signed in during every hour of a school year.
+
+    The stamps of the year's events are loaded in one query and spread over
+    a (user x day x hour) array in local time, without a loop per hour.
+    Also returns the (id, name, is student) of each user row.
+    """
+    rows = db.session.execute(
+        select(
+            Stamps.user_id,
+            User.name,
+            select(Student.id).where(Student.user_id == User.id).exists(),
+            Stamps.start,
+            Stamps.end,
+        )
+        .join(Event, Stamps.event_id == Event.id)
+        .join(User, Stamps.user_id == User.id)
+        .where(Event.school_year == year)
+    ).all()
+
+    first_day = datetime.combine(season_start(year), datetime.min.time())
+    days = (season_start(year + 1) - season_start(year)).days
+    users = list(dict.fromkeys((user_id, name, student) for user_id, name, student, _, _ in rows))
+    grid = np.zeros((len(users), days, 24))
+    if not rows:
+        return grid, users
+
+    index = {user[0]: i for i, user in enumerate(users)}
+    user_idx = np.array([index[row[0]] for row in rows])
+
+    def seconds(times) -> np.ndarray:
+        "Local wall clock seconds since the start of the season"
+        return np.array(
+            [
+                (correct_time_from_storage(t).replace(tzinfo=None) - first_day).total_seconds()
+                for t in times
+            ]
+        )
+
+    starts = np.clip(seconds(row[3] for row in rows), 0, days * 86400)
+    ends = np.clip(seconds(row[4] for row in rows), starts, days * 86400)
+    keep = ends > starts
+    user_idx, starts, ends = user_idx[keep], starts[keep], ends[keep]
+
+    # One entry per (stamp, hour it touches)
+    first_hour = (starts // 3600).astype(int)
+    hours_touched = np.ceil(ends / 3600).astype(int) - first_hour
+    stamp = np.repeat(np.arange(len(starts)), hours_touched)
+    offset = np.arange(len(stamp)) - np.repeat(
+        np.cumsum(hours_touched) - hours_touched, hours_touched
+    )
+    hour = first_hour[stamp] + offset
+    overlap = np.minimum(ends[stamp], (hour + 1) * 3600) - np.maximum(starts[stamp], hour * 3600)
+    np.add.at(grid, (user_idx[stamp], hour // 24, hour % 24), overlap)
+    return grid, users
+
+
+def summarize(year: int) -> dict:
+    "Heatmap and trends of a school year, ready to be sent as JSON"
+    grid, users = load_grid(year)
+    start = season_start(year)
+    days = grid.shape[1]
+
+    # Total hours by weekday and hour of the day
+    weekday = (start.weekday() + np.arange(days)) % 7
+    heatmap = np.zeros((7, 24))
+    np.add.at(heatmap, weekday, grid.sum(axis=0) / 3600)
+
+    # Hours of each user in each week, up to the current week of the season
+    weeks = -(-days // 7)
+    current_week = min((date.today() - start).days // 7, weeks - 1)
+    weekly = np.zeros((weeks, len(users)))
+    np.add.at(weekly, np.arange(days) // 7, grid.sum(axis=2).T / 3600)
+    weekly = weekly.T[:, : max(current_week, 0) + 1]
+
+    attended = weekly > 0
+    active = attended.sum(axis=0)
+    stayed = (attended[:, 1:] & attended[:, :-1]).sum(axis=0)
+    retention = np.divide(
+        stayed, active[:-1], out=np.full(stayed.shape, np.nan), where=active[:-1] > 0
+    )
+
+    # Least squares slope of each student's weekly hours over the recent weeks
+    recent = weekly[:, -TREND_WEEKS:]
+    x = np.arange(recent.shape[1]) - (recent.shape[1] - 1) / 2
+    denominator = (x**2).sum()
+    slopes = (recent - recent.mean(axis=1, keepdims=True)) @ x / (denominator or 1)
+    trending_down = sorted(
+        (
+            {
+                "user_id": user_id,
+                "name": name,
+                "slope": round(float(slopes[i]), 2),
+                "weekly_hours": [round(float(hours), 1) for hours in recent[i]],
+            }
+            for i, (user_id, name, student) in enumerate(users)
+            if student and slopes[i] < 0
+        ),
+        key=lambda trend: trend["slope"],
+    )
+
+    return {
+        "year": year,
+        "heatmap": {
+            "weekdays": WEEKDAYS,
+            "hours": [[round(float(hours), 1) for hours in row] for row in heatmap],
+        },
+        "weeks": [
+            {
+                "start": (start + timedelta(weeks=week)).isoformat(),
+                "active_users": int(active[week]),
+                "hours": round(float(weekly[:, week].sum()), 1),
+                "retention": None
+                if week == 0 or np.isnan(retention[week - 1])
+                else round(float(retention[week - 1]), 2),
+            }
+            for week in range(weekly.shape[1])
+        ],
+        "trending_down": trending_down,
+    }
+
+
+class SummaryCache:
+    "Summaries by school year, dropped whenever stamps or users change"
+
+    def __init__(self):
+        self.summaries: dict[int, dict] = {}
+        # Bumped by every invalidation, so a summary computed during one isn't stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, year: int) -> dict:
+        if (summary := self.summaries.get(year)) is not None:
+            return summary
+        generation = self.generation
+        summary = summarize(year)
+        with self.lock:
+            if generation == self.generation:
+                self.summaries[year] = summary
+        return summary
+
+    def invalidate(self, tables: set[str]):
+        if tables & TABLES:
+            with self.lock:
+                self.generation += 1
+                self.summaries.clear()
+
+
+def requested_summary() -> dict | None:
+    "The summary of the school year in the query, this one by default"
+    year = request.args.get("year", school_year_for_date(date.today()), type=int)
+    if not MINYEAR < year < MAXYEAR:
+        return None
+    return current_app.extensions["analytics"].get(year)
+
+
+@analytics.route("/")
+@mentor_required
+@read_replica
+def overview():
+    if not (summary := requested_summary()):
+        return Response("Error: Invalid school year", HTTPStatus.BAD_REQUEST)
+    peak = max((max(row) for row in summary["heatmap"]["hours"]), default=0) or 1
+    return render_template("analytics.html.jinja2", summary=summary, peak=peak)
+
+
+@analytics.route("/heatmap")
+@mentor_required
+@read_replica
+def heatmap():
+    """Hours by weekday and hour of the day for a school year (?year=).
+
+    This function returns a JSON object, not a web page.
+    """
+    if not (summary := requested_summary()):
+        return Response("Error: Invalid school year", HTTPStatus.BAD_REQUEST)
+    return jsonify({"year": summary["year"], **summary["heatmap"]})
+
+
+@analytics.route("/trends")
+@mentor_required
+@read_replica
+def trends():
+    """Weekly attendance and retention, and the students whose hours are falling.
+
+    This function returns a JSON object, not a web page.
+    """
+    if not (summary := requested_summary()):
+        return Response("Error: Invalid school year", HTTPStatus.BAD_REQUEST)
+    return jsonify(
+        {
+            "year": summary["year"],
+            "weeks": summary["weeks"],
+            "trending_down": summary["trending_down"],
+        }
+    )
+
+
+def init_app(app: Flask):
+    cache = app.extensions["analytics"] = SummaryCache()
+    subscribe(app, lambda changes: cache.invalidate(changed_tables(changes)))
+    app.register_blueprint(analytics)
@@ -0,0 +1,102 @@
+import glob
+import hashlib
+import json
+import os
+
+import click
+from flask import Flask, current_app, request, url_for
+from flask.cli import with_appcontext
+
+# Maps each bundle name to its fingerprinted file in the static folder
+MANIFEST = "assets.json"
+
+BUNDLES = {
+    "custom_css": "custom.scss",
+}
+
+
+def manifest_path(app: Flask) -> str:
+    return os.path.join(app.static_folder, MANIFEST)
+
+
+def compile_bundle(app: Flask, source: str) -> str:
+    "Compile an SCSS file to minified CSS"
+    import cssmin
+    import sass
+
+    css = sass.compile(filename=os.path.join(app.static_folder, source))
+    return cssmin.cssmin(css)
+
+
+@click.command("build-assets")
+@with_appcontext
+def build_assets_command():
+    """Compile and fingerprint the stylesheets."""
+
+    app = current_app
+    manifest = {}
+    for name, source in BUNDLES.items():
+        css = compile_bundle(app, source)
+        stem = os.path.splitext(source)[0]
+        filename = f"{stem}.{hashlib.sha256(css.encode()).hexdigest()[:12]}.css"
+        # Remove stale builds so the static folder doesn't grow with every deploy
+        for old in glob.glob(os.path.join(app.static_folder, f"{stem}.*.css")):
+            os.remove(old)
+        with open(os.path.join(app.static_folder, filename), "w") as f:
+            f.write(css)
+        manifest[name] = filename
+        click.echo(f"Built {filename}")
+
+    with open(manifest_path(app), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def init_app(app: Flask):
+    app.cli.add_command(build_assets_command)
+
+    try:
+        with open(manifest_path(app)) as f:
+            manifest: dict[str, str] = json.load(f)
+    except FileNotFoundError:
+        manifest = None
+
+    if manifest is None:
+        # No prebuilt assets, so compile them on demand like a development checkout
+        from flask_assets import Bundle, Environment
+
+        env = Environment(app)
+        for name, source in BUNDLES.items():
+            env.register(
+                name,
+                Bundle(
+                    source,
+                    filters="libsass,cssmin",
+                    depends="scss/*.scss",
+                    output=f"{os.path.splitext(source)[0]}.generated.css",
+                ),
+            )
+
+        def asset_url(name: str) -> str:
+            return env[name].urls()[0]
+
+    else:
+        hashed_files = set(manifest.values())
+
+        def asset_url(name: str) -> str:
+            return url_for("static", filename=manifest[name])
+
+        @app.after_request
+        def cache_hashed_assets(response):
+            if (
+                request.endpoint == "static"
+                and request.view_args.get("filename") in hashed_files
+                and response.status_code == 200
+            ):
+                # The file name changes whenever the content does
+                response.cache_control.public = True
+                response.cache_control.max_age = 365 * 24 * 60 * 60
+                response.cache_control.immutable = True
+                response.cache_control.no_cache = None
+            return response
+
+    app.add_template_global(asset_url)
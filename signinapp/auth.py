@@ -8,12 +8,12 @@ from flask_login import (
     logout_user,
 )
 from flask_wtf import FlaskForm
-from werkzeug.security import check_password_hash, generate_password_hash
 from wtforms import BooleanField, PasswordField, StringField, SubmitField
 from wtforms.validators import DataRequired, EqualTo, Length
 
 from .forms import UserForm
 from .model import Guardian, Pronoun, Role, ShirtSizes, Student, Subteam, User, db
+from .passwords import check_password, hash_password, needs_rehash
 
 login_manager = LoginManager()
 
@@ -158,7 +158,7 @@ def register_guardian():
         user = Guardian.get_from(form.name.data, form.phone_number.data, form.email.data, 0).user
         user.name = form.name.data
         if form.password.data:
-            user.password = generate_password_hash(form.password.data)
+            user.password = hash_password(form.password.data)
         user.role = Role.from_name("guardian")
         user.preferred_name = form.preferred_name.data
         user.phone_number = form.phone_number.data
@@ -187,7 +187,7 @@ def login():
         # if this returns a user, then the email already exists in database
         user = User.from_email(email)
 
-        if not user or not check_password_hash(user.password, password):
+        if not user or not check_password(user.password, password):
             flash("Please check your login details and try again.")
             return redirect(url_for("auth.login"))
 
@@ -195,6 +195,11 @@ def login():
             flash("User is not approved")
             return redirect(url_for("auth.login"))
 
+        # Bring the hash up to the configured cost while the password is at hand
+        if needs_rehash(user.password):
+            user.password = hash_password(password)
+            db.session.commit()
+
         login_user(user, remember=remember)
 
         return redirect(request.args.get("next") or url_for("index"))
@@ -212,11 +217,11 @@ def logout():
 def password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
-        if not check_password_hash(current_user.password, form.current_password.data):
+        if not check_password(current_user.password, form.current_password.data):
             flash("Incorrect current password")
             return redirect(url_for("auth.password"))
 
-        current_user.password = generate_password_hash(form.new_password.data)
+        current_user.password = hash_password(form.new_password.data)
         db.session.commit()
         return redirect(url_for("user.profile", email=current_user.email))
 
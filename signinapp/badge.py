@@ -1,13 +1,23 @@
-from flask import Blueprint, Flask, flash, redirect, request, url_for
+from flask import Blueprint, Flask, current_app, flash, redirect, request, url_for
 from flask.templating import render_template
 from flask_login import login_required
 from flask_wtf import FlaskForm
 from sqlalchemy.future import select
-from wtforms import BooleanField, SelectField, StringField, SubmitField
-from wtforms.validators import DataRequired
+from wtforms import BooleanField, IntegerField, SelectField, StringField, SubmitField
+from wtforms.validators import DataRequired, NumberRange, ValidationError
 from wtforms.widgets import ColorInput
 
-from .model import Badge, BadgeAward, Subteam, User, db, get_form_ids
+from .model import (
+    Badge,
+    BadgeAward,
+    BadgeRule,
+    EventType,
+    RuleKind,
+    Subteam,
+    User,
+    db,
+    get_form_ids,
+)
 from .util import MultiCheckboxField, admin_required, mentor_required
 
 bp = Blueprint("badge", __name__, url_prefix="/badge")
@@ -27,6 +37,32 @@ class BadgeAwardForm(FlaskForm):
     submit = SubmitField()
 
 
+class BadgeRuleForm(FlaskForm):
+    kind = SelectField("Rule", choices=RuleKind.get_kind_options())
+    threshold = IntegerField(
+        "Hours or Events",
+        default=0,
+        validators=[NumberRange(min=0, message="Must not be negative")],
+    )
+    event_type = SelectField(
+        "Event Type", choices=lambda: get_form_ids(EventType, add_null_id=True), coerce=int
+    )
+    current_year = BooleanField("This School Year Only", default=True)
+    subteam = SelectField(choices=lambda: get_form_ids(Subteam, add_null_id=True), coerce=int)
+    required_badge = SelectField(
+        "Badge", choices=lambda: get_form_ids(Badge, add_null_id=True), coerce=int
+    )
+    submit = SubmitField("Add Rule")
+
+    def validate_subteam(self, field):
+        if self.kind.data == RuleKind.Subteam.name and not field.data:
+            raise ValidationError("Choose the subteam")
+
+    def validate_required_badge(self, field):
+        if self.kind.data == RuleKind.Badge.name and not field.data:
+            raise ValidationError("Choose the badge")
+
+
 class BadgeSearchForm(FlaskForm):
     badge = SelectField(choices=lambda: get_form_ids(Badge))
     subteam = SelectField(choices=lambda: get_form_ids(Subteam, add_null_id=True))
@@ -121,6 +157,60 @@ def edit():
     )
 
 
+def award_by_rules(badge: Badge):
+    "Award a badge to everyone who meets its rules now"
+    awarded = current_app.extensions["badge_rules"].award(badge_ids={badge.id})
+    db.session.commit()
+    if awarded[badge.id]:
+        flash(f"Awarded {badge.name} to {awarded[badge.id]} users")
+
+
+@bp.route("/rules", methods=["GET", "POST"])
+@admin_required
+def rules():
+    badge = db.session.get(Badge, request.args["badge_id"])
+
+    if not badge:
+        flash("Badge does not exist")
+        return redirect(url_for("badge.all"))
+
+    form = BadgeRuleForm()
+    if form.validate_on_submit():
+        kind = RuleKind[form.kind.data]
+        badge.rules.append(
+            BadgeRule(
+                kind=kind,
+                threshold=form.threshold.data,
+                event_type_id=form.event_type.data or None,
+                current_year=form.current_year.data,
+                subteam_id=form.subteam.data if kind == RuleKind.Subteam else None,
+                required_badge_id=form.required_badge.data if kind == RuleKind.Badge else None,
+            )
+        )
+        db.session.commit()
+        award_by_rules(badge)
+        return redirect(url_for("badge.rules", badge_id=badge.id))
+
+    return render_template("badge_rules.html.jinja2", badge=badge, form=form)
+
+
+@bp.route("/rules/delete", methods=["POST"])
+@admin_required
+def delete_rule():
+    rule = db.session.get(BadgeRule, request.args.get("rule_id"))
+    if not rule:
+        flash("Invalid rule ID")
+        return redirect(url_for("badge.all"))
+
+    badge = rule.badge
+    db.session.delete(rule)
+    db.session.commit()
+    # The remaining rules may now be met by more users
+    if badge.rules:
+        award_by_rules(badge)
+    return redirect(url_for("badge.rules", badge_id=badge.id))
+
+
 @bp.route("/search", methods=["GET", "POST"])
 @mentor_required
 def search():
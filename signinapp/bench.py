@@ -0,0 +1,458 @@
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+
+STARTUP_SCRIPT = """
+import json, time
+t0 = time.perf_counter()
+import signinapp
+t1 = time.perf_counter()
+app = signinapp.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "MIGRATE_ENABLED": False})
+t2 = time.perf_counter()
+app.test_client().get("/login")
+t3 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "create_app": t2 - t1, "first request": t3 - t2}))
+"""
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+# Error text of the database errors caused by waiting on locks
+LOCK_ERROR_RE = re.compile(
+    r"database is locked|deadlock detected|lock timeout|could not obtain lock|could not serialize"
+)
+
+
+@click.group()
+def bench():
+    """Performance benchmarks."""
+
+
+def report(name: str, samples: list[float], unit="ms", scale=1000.0):
+    click.echo(
+        f"{name:>16}: min {min(samples) * scale:8.1f}{unit}"
+        f"  median {statistics.median(samples) * scale:8.1f}{unit}"
+        f"  max {max(samples) * scale:8.1f}{unit}"
+    )
+
+
+def percentiles(samples: list[float], scale=1000.0) -> str:
+    if len(samples) < 2:
+        return "-"
+    cuts = statistics.quantiles(samples, n=100)
+    return f"p50 {cuts[49] * scale:7.1f}ms  p99 {cuts[98] * scale:7.1f}ms"
+
+
+@bench.command("startup")
+@click.option("--runs", default=5, show_default=True, help="Number of fresh interpreters")
+def startup_command(runs: int):
+    """Time a cold import, app creation and the first request."""
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    for phase in results[0]:
+        report(phase, [r[phase] for r in results])
+
+
+def run_scans(config: dict, scans: int, users: int, threads: int):
+    """Scan users in and out of a new event from many threads at once.
+
+    Returns the (user id, outcome, latency) of each scan, the total time taken
+    and the number of users whose active and stamps rows don't match the toggles.
+    """
+    from sqlalchemy import func, select
+    from sqlalchemy.exc import OperationalError
+
+    from . import create_app, init_default_db
+    from .model import Active, Event, Stamps, User, db
+
+    app = create_app({"MIGRATE_ENABLED": False, **config})
+    with app.app_context():
+        db.create_all()
+        init_default_db()
+        now = datetime.now(tz=UTC)
+        event_id = Event.create(
+            "Scan benchmark", "", "", now, now + timedelta(hours=1), "Training"
+        ).id
+        user_ids = [
+            User.make(
+                f"scan-bench-{now.timestamp()}-{i}@signin.chopshoplib.info",
+                f"Scan Bench {i}",
+                password="",
+                role="student",
+                approved=True,
+            ).id
+            for i in range(users)
+        ]
+        db.session.commit()
+
+    def scan(user_id: int):
+        with app.app_context():
+            start = time.perf_counter()
+            try:
+                result = db.session.get(Event, event_id).scan(db.session.get(User, user_id))
+            except OperationalError as e:
+                db.session.rollback()
+                outcome = "lock" if LOCK_ERROR_RE.search(str(e)) else "error"
+                return user_id, outcome, time.perf_counter() - start
+            if not result.changed:
+                outcome = "ignored"
+            elif result.event == "in":
+                outcome = "in"
+            else:
+                outcome = "out"
+            return user_id, outcome, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(scan, (user_ids[i % users] for i in range(scans))))
+    elapsed = time.perf_counter() - start
+
+    # Every applied toggle must be reflected in the tables exactly once
+    failures = 0
+    with app.app_context():
+        for user_id in user_ids:
+            toggles = Counter(outcome for uid, outcome, _ in results if uid == user_id)
+            active, stamps = (
+                db.session.scalar(
+                    select(func.count())
+                    .select_from(model)
+                    .filter_by(user_id=user_id, event_id=event_id)
+                )
+                for model in (Active, Stamps)
+            )
+            if stamps != toggles["out"] or active != toggles["in"] - toggles["out"]:
+                failures += 1
+                click.echo(
+                    f"User {user_id}: {toggles['in']} in, {toggles['out']} out, "
+                    f"but {active} active and {stamps} stamps",
+                    err=True,
+                )
+        db.engine.dispose()
+    return results, elapsed, failures
+
+
+@bench.command("scans")
+@click.option("--scans", default=500, show_default=True, help="Total number of scans")
+@click.option("--users", default=10, show_default=True, help="Number of users being scanned")
+@click.option("--threads", default=50, show_default=True, help="Scans in flight at once")
+@click.option("--debounce", default=0.0, show_default=True, help="SCAN_DEBOUNCE_SECONDS to use")
+@click.option("--profile", default="auto", show_default=True, help="DB_PROFILE to use")
+@click.option("--uri", help="Scratch database to use instead of a temporary SQLite file")
+def scans_command(
+    scans: int, users: int, threads: int, debounce: float, profile: str, uri: str | None
+):
+    """Fire simultaneous scans and check each toggle was applied exactly once."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results, elapsed, failures = run_scans(
+            {
+                "SQLALCHEMY_DATABASE_URI": uri or f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                "SCAN_DEBOUNCE_SECONDS": debounce,
+                "DB_PROFILE": profile,
+            },
+            scans,
+            users,
+            threads,
+        )
+
+    counts = Counter(outcome for _, outcome, _ in results)
+    click.echo(
+        f"{scans} scans in {elapsed:.2f}s ({scans / elapsed:.0f}/s): "
+        + ", ".join(f"{n} {outcome}" for outcome, n in sorted(counts.items()))
+    )
+    report("latency", [latency for _, _, latency in results])
+    if failures:
+        raise click.ClickException(f"{failures} users have inconsistent scans")
+    click.echo("All scans consistent")
+
+
+@bench.command("contention")
+@click.option("--scans", default=1000, show_default=True, help="Total number of scans")
+@click.option("--users", default=50, show_default=True, help="Number of users being scanned")
+@click.option("--threads", default=20, show_default=True, help="Scans in flight at once")
+@click.option("--uri", help="Scratch database to use instead of a temporary SQLite file")
+def contention_command(scans: int, users: int, threads: int, uri: str | None):
+    """Compare write contention on the scan path with and without the database profile."""
+
+    for profile in ("none", "auto"):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {
+                "SQLALCHEMY_DATABASE_URI": uri or f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                "SCAN_DEBOUNCE_SECONDS": 0,
+                "DB_PROFILE": profile,
+            }
+            results, elapsed, failures = run_scans(config, scans, users, threads)
+        counts = Counter(outcome for _, outcome, _ in results)
+        click.echo(
+            f"{profile:>6}: {scans / elapsed:6.0f} scans/s  "
+            f"{percentiles([latency for _, _, latency in results])}  "
+            f"lock errors {counts['lock']}  other errors {counts['error']}  "
+            f"inconsistent users {failures}"
+        )
+
+
+class Kiosk(threading.Thread):
+    "A display account that scans and polls like a kiosk at the door"
+
+    def __init__(self, url, email, password, event_code, codes, duration, poll_ratio, think):
+        super().__init__(daemon=True)
+        import requests
+
+        self.session = requests.Session()
+        self.url = url.rstrip("/")
+        self.email = email
+        self.password = password
+        self.event_code = event_code
+        self.codes = codes
+        self.duration = duration
+        self.poll_ratio = poll_ratio
+        self.think = think
+        # (endpoint, outcome, latency) of every request
+        self.results: list[tuple[str, str, float]] = []
+
+    def login(self):
+        page = self.session.get(f"{self.url}/login")
+        token = CSRF_RE.search(page.text)
+        resp = self.session.post(
+            f"{self.url}/login",
+            data={
+                "email": self.email,
+                "password": self.password,
+                "csrf_token": token.group(1) if token else "",
+            },
+            allow_redirects=False,
+        )
+        if resp.status_code != 302 or resp.headers["Location"].endswith("/login"):
+            raise click.ClickException(f"Could not log in as {self.email}")
+
+    def request(self, endpoint: str, method: str, **kwargs):
+        import requests
+
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(method, f"{self.url}{endpoint}", **kwargs)
+        except requests.RequestException:
+            outcome = "connection"
+        else:
+            if resp.ok:
+                outcome = "ok"
+            elif LOCK_ERROR_RE.search(resp.text):
+                outcome = "lock"
+            else:
+                outcome = str(resp.status_code)
+        self.results.append((endpoint, outcome, time.perf_counter() - start))
+
+    def run(self):
+        deadline = time.monotonic() + self.duration
+        while time.monotonic() < deadline:
+            if random.random() < self.poll_ratio:
+                self.request("/active", "GET", params={"event": self.event_code})
+            else:
+                self.request(
+                    "/scan",
+                    "POST",
+                    data={"user_code": random.choice(self.codes), "event_code": self.event_code},
+                )
+            time.sleep(random.expovariate(1 / self.think) if self.think else 0)
+
+
+@bench.command("logins")
+@click.option("--logins", default=100, show_default=True, help="Total number of logins")
+@click.option("--users", default=20, show_default=True, help="Number of users logging in")
+@click.option("--threads", default=20, show_default=True, help="Logins in flight at once")
+@click.option("--method", help="PASSWORD_METHOD to use instead of the configured one")
+@click.option("--workers", type=int, help="PASSWORD_WORKERS to use instead of the configured one")
+@with_appcontext
+def logins_command(logins: int, users: int, threads: int, method: str | None, workers: int | None):
+    """Log in from many threads at once and report logins per second per core.
+
+    Compare values of --method to pick a PASSWORD_METHOD the server can keep
+    up with; a login costs about one hash.
+    """
+    from flask import current_app
+    from sqlalchemy import insert
+
+    from . import create_app, init_default_db
+    from .model import Role, User, db
+    from .passwords import hash_password
+
+    method = method or current_app.config["PASSWORD_METHOD"]
+    if workers is None:
+        workers = current_app.config["PASSWORD_WORKERS"]
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                "MIGRATE_ENABLED": False,
+                "WTF_CSRF_ENABLED": False,
+                "PASSWORD_METHOD": method,
+                "PASSWORD_WORKERS": workers,
+                "PASSWORD_QUEUE": max(threads, current_app.config["PASSWORD_QUEUE"]),
+            }
+        )
+        with app.app_context():
+            db.create_all()
+            init_default_db()
+            start = time.perf_counter()
+            password = hash_password("load-test")
+            hash_time = time.perf_counter() - start
+            # Every user shares the one hash, rather than waiting for a hash each
+            db.session.execute(
+                insert(User),
+                [
+                    {
+                        "email": f"login-bench-{i}@signin.chopshoplib.info",
+                        "name": f"Login Bench {i}",
+                        "password": password,
+                        "role_id": Role.from_name("student").id,
+                        "approved": True,
+                    }
+                    for i in range(users)
+                ],
+            )
+            db.session.commit()
+
+        def login(i: int):
+            start = time.perf_counter()
+            response = app.test_client().post(
+                "/login",
+                data={
+                    "email": f"login-bench-{i % users}@signin.chopshoplib.info",
+                    "password": "load-test",
+                },
+            )
+            if response.status_code == 302 and "/login" not in response.location:
+                outcome = "ok"
+            elif response.status_code == 503:
+                outcome = "busy"
+            else:
+                outcome = "failed"
+            return outcome, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            results = list(pool.map(login, range(logins)))
+        elapsed = time.perf_counter() - start
+        with app.app_context():
+            db.engine.dispose()
+
+    cores = min(threads, app.extensions["passwords"].workers, os.cpu_count() or 1)
+    counts = Counter(outcome for outcome, _ in results)
+    rate = counts["ok"] / elapsed
+    click.echo(f"{method}: {hash_time * 1000:.0f}ms per hash")
+    click.echo(
+        f"{logins} logins in {elapsed:.2f}s on {cores} cores: {rate:.1f}/s, "
+        f"{rate / cores:.1f}/s per core, "
+        + ", ".join(f"{n} {outcome}" for outcome, n in sorted(counts.items()))
+    )
+    report("latency", [latency for _, latency in results])
+
+
+@bench.command("kiosks")
+@click.option("--url", default="http://localhost:5000", show_default=True, help="Running app")
+@click.option("--kiosks", default=4, show_default=True, help="Number of simulated kiosks")
+@click.option("--users", default=100, show_default=True, help="Number of users being scanned")
+@click.option("--duration", default=30.0, show_default=True, help="Seconds to run for")
+@click.option("--poll-ratio", default=0.2, show_default=True, help="Share of requests to /active")
+@click.option("--think", default=0.5, show_default=True, help="Mean seconds between requests")
+@click.option("--event", "event_code", help="Event to scan into instead of a new one")
+@click.option("--password", default="load-test", show_default=True, help="Kiosk password")
+@with_appcontext
+def kiosks_command(
+    url: str,
+    kiosks: int,
+    users: int,
+    duration: float,
+    poll_ratio: float,
+    think: float,
+    event_code: str | None,
+    password: str,
+):
+    """Load test a running app with kiosks scanning users in and out.
+
+    The kiosk accounts, users and event are added to the configured database,
+    which must be the one the app at --url uses, so only point this at a
+    scratch copy of the database.
+    """
+
+    from .model import Event, User, db
+    from .passwords import hash_password
+
+    emails = [f"load-test-kiosk-{i}@signin.chopshoplib.info" for i in range(kiosks)]
+    for i, email in enumerate(emails):
+        if kiosk := User.from_email(email):
+            kiosk.password = hash_password(password)
+        else:
+            User.make(
+                email, f"Load Test Kiosk {i}", password=password, role="display", approved=True
+            )
+    codes = []
+    for i in range(users):
+        email = f"load-test-user-{i}@signin.chopshoplib.info"
+        user = User.from_email(email) or User.make(
+            email, f"Load Test User {i}", password="", role="student", approved=True
+        )
+        codes.append(user.code)
+    if not event_code:
+        now = datetime.now(tz=UTC)
+        event_code = Event.create(
+            "Load test", "", "", now, now + timedelta(seconds=duration, hours=1), "Training"
+        ).code
+    db.session.commit()
+
+    threads = [
+        Kiosk(url, email, password, event_code, codes, duration, poll_ratio, think)
+        for email in emails
+    ]
+    for kiosk in threads:
+        kiosk.login()
+    start = time.perf_counter()
+    for kiosk in threads:
+        kiosk.start()
+    for kiosk in threads:
+        kiosk.join()
+    elapsed = time.perf_counter() - start
+
+    results = [result for kiosk in threads for result in kiosk.results]
+    scans = [r for r in results if r[0] == "/scan"]
+    click.echo(
+        f"{kiosks} kiosks, {len(results)} requests in {elapsed:.1f}s, "
+        f"{sum(r[1] == 'ok' for r in scans) / elapsed:.1f} scans/s"
+    )
+    for endpoint in ("/scan", "/active"):
+        samples = [r for r in results if r[0] == endpoint]
+        if not samples:
+            continue
+        outcomes = Counter(outcome for _, outcome, _ in samples)
+        errors = len(samples) - outcomes["ok"]
+        click.echo(
+            f"{endpoint:>8}: {len(samples):6} requests  "
+            f"{percentiles([latency for _, _, latency in samples])}  "
+            f"errors {errors / len(samples):6.1%}  lock errors {outcomes['lock']}"
+        )
+        for outcome, n in sorted(outcomes.items()):
+            if outcome not in ("ok", "lock"):
+                click.echo(f"{'':>10}{n} x {outcome}")
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import secrets
+import select
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, NamedTuple
+
+from flask import Flask, current_app, has_app_context
+from sqlalchemy import Engine, NullPool, create_engine, event, func, inspect
+from sqlalchemy import select as sql_select
+from sqlalchemy.engine import make_url
+
+from .database import RoutingSession
+
+# Session.info key of the changes made in the current transaction
+PENDING = "pending_changes"
+# PostgreSQL channel the workers LISTEN on
+CHANNEL = "signin_changes"
+# Larger batches are sent to other workers as one change per table
+MAX_MESSAGE_CHANGES = 100
+# Seconds to wait before listening again after an error
+RETRY_INTERVAL = 5
+
+
+class Change(NamedTuple):
+    table: str
+    # None for bulk statements, which don't say which rows they touched
+    pk: Any
+    op: str  # insert, update or delete
+
+
+Subscriber = Callable[[list[Change]], None]
+
+
+def changed_tables(changes: Iterable[Change]) -> set[str]:
+    return {change.table for change in changes}
+
+
+def encode(origin: str, changes: list[Change]) -> str:
+    if len(changes) > MAX_MESSAGE_CHANGES:
+        changes = list(dict.fromkeys(Change(table, None, op) for table, _, op in changes))
+    return json.dumps({"origin": origin, "changes": changes}, default=str)
+
+
+def decode(message: str) -> tuple[str, list[Change]]:
+    data = json.loads(message)
+    return data["origin"], [Change(*change) for change in data["changes"]]
+
+
+class FileTransport:
+    """Changes appended as lines to a log file that every worker tails.
+
+    For SQLite deployments, where all the workers share one machine.
+    """
+
+    def __init__(self, path: str, interval: float, max_size: int = 1024 * 1024):
+        self.path = path
+        self.interval = interval
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def send(self, message: str):
+        try:
+            if os.stat(self.path).st_size > self.max_size:
+                # Readers finish the old file through their open handle
+                os.replace(self.path, f"{self.path}.old")
+        except FileNotFoundError:
+            pass
+        # Appends this small are written in one piece, so lines don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, message.encode() + b"\n")
+        finally:
+            os.close(fd)
+
+    def open(self):
+        return open(self.path, "a+b")
+
+    def rotated(self, f) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def receive(self) -> Iterator[str]:
+        f = self.open()
+        f.seek(0, os.SEEK_END)
+        partial = b""
+        try:
+            while True:
+                line = f.readline()
+                if line.endswith(b"\n"):
+                    yield (partial + line).decode()
+                    partial = b""
+                elif line:
+                    # The rest of the line hasn't been written yet
+                    partial += line
+                elif self.rotated(f):
+                    f.close()
+                    f = self.open()
+                    partial = b""
+                else:
+                    time.sleep(self.interval)
+        finally:
+            f.close()
+
+
+class NotifyTransport:
+    "Changes sent to every worker with PostgreSQL NOTIFY"
+
+    def __init__(self, engine: Engine, interval: float):
+        self.engine = engine
+        self.interval = interval
+
+    def send(self, message: str):
+        # The session's transaction is over by now, so this needs its own
+        with self.engine.connect() as conn:
+            conn.execute(sql_select(func.pg_notify(CHANNEL, message)))
+            conn.commit()
+
+    def receive(self) -> Iterator[str]:
+        # A connection outside the pool, since it's held for the life of the worker
+        listener = create_engine(self.engine.url, poolclass=NullPool)
+        connection = listener.raw_connection()
+        try:
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            while True:
+                if select.select([dbapi_connection], [], [], self.interval)[0]:
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        yield dbapi_connection.notifies.pop(0).payload
+        finally:
+            connection.invalidate()
+            listener.dispose()
+
+
+class ChangeBus:
+    """Tells subscribers about the rows changed by each commit.
+
+    Changes committed by this worker are passed to the subscribers straight
+    away, and sent through the transport to the other workers. A listener
+    thread passes theirs on in turn. Notifications can be lost while a
+    listener reconnects, so caches should still expire eventually.
+    """
+
+    def __init__(self, transport: FileTransport | NotifyTransport | None, logger: logging.Logger):
+        self.transport = transport
+        self.logger = logger
+        self.subscribers: list[Subscriber] = []
+        self.origin = secrets.token_hex(8)
+        self.pid: int | None = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback: Subscriber) -> Subscriber:
+        self.subscribers.append(callback)
+        return callback
+
+    def dispatch(self, changes: list[Change]):
+        for callback in self.subscribers:
+            try:
+                callback(changes)
+            except Exception:
+                self.logger.exception("Change subscriber %r failed", callback)
+
+    def publish(self, changes: list[Change]):
+        self.dispatch(changes)
+        if self.transport is None:
+            return
+        try:
+            self.transport.send(encode(self.origin, changes))
+        except Exception:
+            self.logger.exception("Could not send changes to the other workers")
+
+    def start(self):
+        "Listen for other workers' changes, once in each process"
+        if self.transport is None or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # Forked workers would otherwise share the origin and ignore each other
+            self.origin = secrets.token_hex(8)
+            threading.Thread(target=self.listen, name="change-bus", daemon=True).start()
+
+    def listen(self):
+        while True:
+            try:
+                for message in self.transport.receive():
+                    origin, changes = decode(message)
+                    if origin != self.origin:
+                        self.dispatch(changes)
+            except Exception:
+                self.logger.exception("Lost the change bus, listening again")
+            time.sleep(RETRY_INTERVAL)
+
+
+def subscribe(app: Flask, callback: Subscriber) -> Subscriber:
+    "Call `callback` with the changes of every commit, from any worker"
+    return app.extensions["changes"].subscribe(callback)
+
+
+def record_flush(session, flush_context):
+    changes = session.info.setdefault(PENDING, [])
+    for op, objs in (
+        ("insert", session.new),
+        ("update", session.dirty),
+        ("delete", session.deleted),
+    ):
+        for obj in objs:
+            if op == "update" and not session.is_modified(obj):
+                continue
+            pk = inspect(obj).mapper.primary_key_from_instance(obj)
+            changes.append(Change(obj.__table__.name, pk[0] if len(pk) == 1 else tuple(pk), op))
+
+
+def record_statement(orm_execute_state):
+    for op in ("insert", "update", "delete"):
+        if getattr(orm_execute_state, f"is_{op}"):
+            changes = orm_execute_state.session.info.setdefault(PENDING, [])
+            changes.append(Change(orm_execute_state.statement.table.name, None, op))
+
+
+def publish_committed(session):
+    changes = session.info.pop(PENDING, None)
+    if changes and has_app_context() and (bus := current_app.extensions.get("changes")):
+        bus.publish(changes)
+
+
+def forget_changes(session, transaction):
+    "Drop the changes of a rolled back transaction"
+    if transaction.parent is None:
+        session.info.pop(PENDING, None)
+
+
+def transport(app: Flask) -> FileTransport | NotifyTransport | None:
+    name = app.config["CHANGE_TRANSPORT"]
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if name == "auto":
+        if url.get_backend_name() == "postgresql":
+            name = "notify"
+        elif url.database in (None, "", ":memory:"):
+            # Only this process can see an in-memory database
+            name = "none"
+        else:
+            name = "file"
+
+    interval = app.config["CHANGE_POLL_INTERVAL"]
+    if name == "notify":
+        from .model import db
+
+        with app.app_context():
+            return NotifyTransport(db.engine, interval)
+    if name == "file":
+        app.config.setdefault("CHANGE_LOG", os.path.join(app.instance_path, "changes.log"))
+        return FileTransport(app.config["CHANGE_LOG"], interval)
+    return None
+
+
+def init_app(app: Flask):
+    bus = app.extensions["changes"] = ChangeBus(transport(app), app.logger)
+    # Start listening in the process that serves requests, which may be a forked worker
+    app.before_request(bus.start)
+    if not event.contains(RoutingSession, "after_commit", publish_committed):
+        event.listen(RoutingSession, "after_flush", record_flush)
+        event.listen(RoutingSession, "do_orm_execute", record_statement)
+        event.listen(RoutingSession, "after_commit", publish_committed)
+        event.listen(RoutingSession, "after_transaction_end", forget_changes)
@@ -0,0 +1,54 @@
+import threading
+import time
+from collections.abc import Callable
+
+from flask import Flask, current_app, has_app_context
+
+from .changes import changed_tables, subscribe
+
+
+class ChoiceCache:
+    """Choice lists for select fields, cached until one of their tables is written.
+
+    Entries also expire after FORM_CHOICES_TTL seconds, in case a change from
+    another worker is missed.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries: dict[str, tuple[float, frozenset[str], list]] = {}
+        # Bumped by every invalidation, so a list loaded during one isn't stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str, tables: frozenset[str], load: Callable[[], list]) -> list:
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[2]
+
+        generation = self.generation
+        value = load()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time.monotonic() + self.ttl, tables, value)
+        return value
+
+    def invalidate(self, tables: set[str]):
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if entry[1] & tables]:
+                del self.entries[key]
+
+
+def cached_choices(key: str, tables: frozenset[str], load: Callable[[], list]) -> list:
+    cache: ChoiceCache | None = (
+        current_app.extensions.get("form_choices") if has_app_context() else None
+    )
+    if cache is None or not cache.ttl:
+        return load()
+    return cache.get(key, tables, load)
+
+
+def init_app(app: Flask):
+    cache = app.extensions["form_choices"] = ChoiceCache(app.config["FORM_CHOICES_TTL"])
+    subscribe(app, lambda changes: cache.invalidate(changed_tables(changes)))
@@ -0,0 +1,297 @@
+import itertools
+import sys
+from datetime import timedelta
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import case, or_, update
+from sqlalchemy.future import select
+
+from . import bench, init_default_db, model
+from .model import db
+from .overlaps import OverlapSweep, intervals
+from .roster import (
+    GUARDIAN_FIELDS,
+    STUDENT_FIELDS,
+    csv_lines,
+    import_roster,
+    roster,
+    write_xlsx,
+    xlsx_available,
+)
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """Clear the existing data and create new tables."""
+
+    model.db.create_all()
+    init_default_db()
+
+    click.echo("Initialized the database.")
+
+
+@click.command("gen-codes")
+@with_appcontext
+def gen_codes_command():
+    """Generate user codes for all users."""
+
+    for u in db.session.scalars(select(model.User)):
+        u.code = model.gen_code()
+
+    db.session.commit()
+
+    click.echo("Generated new user codes for all users.")
+
+
+@click.command("generate-secret")
+@with_appcontext
+def generate_secret_command():
+    """Generate a secret key."""
+
+    import secrets
+
+    click.echo(secrets.token_hex())
+
+
+def trim_filters(stmt, year: int | None, event_type_id: int | None, event_id: int | None):
+    "Join a stamps statement to the events, and restrict it to the chosen ones"
+    stmt = stmt.where(model.Stamps.event_id == model.Event.id)
+    if year:
+        stmt = stmt.where(model.Event.school_year == year)
+    if event_type_id:
+        stmt = stmt.where(model.Event.type_id == event_type_id)
+    if event_id:
+        stmt = stmt.where(model.Event.id == event_id)
+    return stmt
+
+
+@click.command("trim-stamps")
+@click.option("--year", type=int, help="Only events in this school year.")
+@click.option("--type", "type_name", help="Only events of this type.")
+@click.option("--event", "event_id", type=int, help="Only the event with this id.")
+@click.option("--dry-run", is_flag=True, help="Show the changes without making them.")
+@click.option("-v", "--verbose", is_flag=True, help="List every stamp that changes.")
+@with_appcontext
+def trim_stamps_command(
+    year: int | None, type_name: str | None, event_id: int | None, dry_run: bool, verbose: bool
+):
+    """Trim stamps to the active time of their event.
+
+    Stamps starting more than PRE_EVENT_ACTIVE_TIME before their event, or ending
+    more than POST_EVENT_ACTIVE_TIME after it, are clipped with one UPDATE per edge.
+    Times are shown as stored, in UTC.
+    """
+    event_type_id = None
+    if type_name:
+        if not (event_type := model.EventType.from_name(type_name)):
+            raise click.BadParameter(f"No event type named {type_name}", param_hint="--type")
+        event_type_id = event_type.id
+
+    Stamps, Event = model.Stamps, model.Event
+    changed = trim_filters(
+        select(
+            Event.id,
+            Event.name,
+            Stamps.id,
+            Stamps.start,
+            Stamps.end,
+            Event.adjusted_start,
+            Event.adjusted_end,
+        )
+        .where(or_(Stamps.start < Event.adjusted_start, Stamps.end > Event.adjusted_end))
+        .order_by(Event.id, Stamps.id),
+        year,
+        event_type_id,
+        event_id,
+    )
+
+    total_stamps = total_events = 0
+    total_removed = timedelta()
+    rows = db.session.execute(changed.execution_options(yield_per=1000))
+    for (ev_id, ev_name), stamps in itertools.groupby(rows, key=lambda row: row[:2]):
+        count = 0
+        removed = timedelta()
+        for _, _, stamp_id, start, end, adjusted_start, adjusted_end in stamps:
+            new_start = min(max(start, adjusted_start), adjusted_end)
+            new_end = max(min(end, adjusted_end), new_start)
+            count += 1
+            removed += (end - start) - (new_end - new_start)
+            if verbose:
+                click.echo(f"  stamp {stamp_id}: {start} - {end} -> {new_start} - {new_end}")
+        click.echo(f"{ev_name} ({ev_id}): {count} stamps, {removed} removed")
+        total_stamps += count
+        total_events += 1
+        total_removed += removed
+
+    click.echo(f"Total: {total_stamps} stamps in {total_events} events, {total_removed} removed")
+    if dry_run or not total_stamps:
+        return
+
+    new_start = case(
+        (Stamps.start < Event.adjusted_start, Event.adjusted_start), else_=Event.adjusted_end
+    )
+    for stmt in (
+        update(Stamps)
+        .where(or_(Stamps.start < Event.adjusted_start, Stamps.start > Event.adjusted_end))
+        .values(start=new_start, duration_seconds=model.seconds_between(new_start, Stamps.end)),
+        update(Stamps)
+        .where(Stamps.end > Event.adjusted_end)
+        .values(
+            end=Event.adjusted_end,
+            duration_seconds=model.seconds_between(Stamps.start, Event.adjusted_end),
+        ),
+        # Stamps entirely outside the event end up empty rather than negative
+        update(Stamps)
+        .where(Stamps.end < Stamps.start)
+        .values(end=Stamps.start, duration_seconds=0),
+    ):
+        db.session.execute(
+            trim_filters(stmt, year, event_type_id, event_id),
+            execution_options={"synchronize_session": False},
+        )
+    db.session.commit()
+    click.echo("Trimmed the stamps.")
+
+
+@click.command("overlaps")
+@click.option("--user", "email", help="Only the user with this email.")
+@click.option("--year", type=int, help="Only stamps of events in this school year.")
+@click.option("--merge", is_flag=True, help="Combine overlapping stamps of the same event.")
+@click.option("--clip", is_flag=True, help="Start overlapping stamps when the earlier one ends.")
+@with_appcontext
+def overlaps_command(email: str | None, year: int | None, merge: bool, clip: bool):
+    """Find stamps of a user that overlap in time.
+
+    Overlapping stamps count the same time twice in hour totals and fund shares.
+    Stamps that are entirely covered by another are removed when clipping.
+    """
+    criteria = []
+    if email:
+        if not (user := model.User.from_email(email)):
+            raise click.BadParameter(f"No user with email {email}", param_hint="--user")
+        criteria.append(model.Stamps.user_id == user.id)
+    if year:
+        criteria.append(model.Event.school_year == year)
+
+    sweep = OverlapSweep(merge=merge, clip=clip)
+    count = 0
+    for first, second, action in sweep.run(intervals(*criteria)):
+        count += 1
+        click.echo(
+            f"{second.user}: {second.event} ({second.stamp_id}) {second.start} - {second.end}"
+            f" overlaps {first.event} ({first.stamp_id}) {first.start} - {first.end}"
+            + (f", {action}" if action else "")
+        )
+
+    click.echo(f"{count} overlapping stamps")
+    if sweep.updates or sweep.deletes:
+        sweep.apply()
+        db.session.commit()
+        click.echo(f"Changed {len(sweep.updates)} stamps and removed {len(sweep.deletes)}.")
+
+
+@click.command("award-badges")
+@click.option("--dry-run", is_flag=True, help="Show the awards without making them.")
+@with_appcontext
+def award_badges_command(dry_run: bool):
+    """Award badges to every user that meets their rules.
+
+    Rules are otherwise checked as stamps and awards are written, so this is
+    for new rules, imported stamps, and rules that count the new school year.
+    """
+    awarded = current_app.extensions["badge_rules"].award()
+    for badge_id, count in sorted(awarded.items()):
+        click.echo(f"{db.session.get(model.Badge, badge_id).name}: {count} users")
+    if dry_run:
+        db.session.rollback()
+        click.echo("Dry run, no badges were awarded.")
+    else:
+        db.session.commit()
+        click.echo(f"Awarded {awarded.total()} badges.")
+
+
+@click.command("export-roster")
+@click.option(
+    "--field",
+    "fields",
+    multiple=True,
+    type=click.Choice(list(STUDENT_FIELDS)),
+    help="Student column to include, repeatable. All by default.",
+)
+@click.option(
+    "--guardian-field",
+    "guardian_fields",
+    multiple=True,
+    type=click.Choice(list(GUARDIAN_FIELDS)),
+    help="Column to include for each guardian, repeatable. All by default.",
+)
+@click.option("--all", "include_all", is_flag=True, help="Include alumni.")
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="File to write, .xlsx for a workbook. Standard output by default.",
+)
+@with_appcontext
+def export_roster_command(
+    fields: tuple[str, ...], guardian_fields: tuple[str, ...], include_all: bool, output: str | None
+):
+    "Export the contact details of students and their guardians, e.g. for registration forms."
+    rows = roster(
+        fields or list(STUDENT_FIELDS),
+        guardian_fields or list(GUARDIAN_FIELDS),
+        include_all=include_all,
+    )
+    if output and output.endswith(".xlsx"):
+        if not xlsx_available():
+            raise click.UsageError("XLSX export needs openpyxl installed")
+        with open(output, "wb") as f:
+            write_xlsx(rows, f)
+    elif output:
+        with open(output, "w", newline="") as f:
+            f.writelines(csv_lines(rows))
+    else:
+        sys.stdout.writelines(csv_lines(rows))
+
+
+@click.command("import-roster")
+@click.argument("file", type=click.File(encoding="utf-8-sig"))
+@click.option("--dry-run", is_flag=True, help="Check the file without creating anyone.")
+@with_appcontext
+def import_roster_command(file, dry_run: bool):
+    """Create the students, mentors and guardians listed in a CSV file.
+
+    Columns are role, name, email, password, preferred_name, phone, address,
+    subteam, shirt, pronouns and graduation_year, and for students
+    guardian_1_name, guardian_1_email, guardian_1_phone and so on. Everyone
+    is created in one transaction, or no one is if any row has an error.
+    """
+    result = import_roster(file, dry_run)
+    if result.errors:
+        db.session.rollback()
+        for error in result.errors:
+            click.echo(error, err=True)
+        raise click.ClickException("Nothing was imported.")
+    for email in result.skipped:
+        click.echo(f"Skipped {email}, who already has an account")
+    if dry_run:
+        db.session.rollback()
+        click.echo(f"Dry run, would have created {result.summary()}.")
+    else:
+        db.session.commit()
+        click.echo(f"Created {result.summary()}.")
+
+
+def init_app(app: Flask):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(gen_codes_command)
+    app.cli.add_command(generate_secret_command)
+    app.cli.add_command(trim_stamps_command)
+    app.cli.add_command(overlaps_command)
+    app.cli.add_command(award_badges_command)
+    app.cli.add_command(export_roster_command)
+    app.cli.add_command(import_roster_command)
+    app.cli.add_command(bench.bench)
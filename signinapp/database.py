@@ -0,0 +1,153 @@
+import functools
+from collections.abc import Mapping
+
+from flask import Flask, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, event
+from sqlalchemy.engine import make_url
+
+# Bind key of the READ_REPLICA_URI engine
+REPLICA = "replica"
+
+# Engine settings for each DB_PROFILE, which DB_PROFILE_SETTINGS can override
+PROFILES = {
+    "none": {},
+    "sqlite": {
+        "journal_mode": "WAL",
+        # Milliseconds to wait for another worker's write lock
+        "busy_timeout": 5000,
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+    },
+    "postgresql": {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+        # Seconds before a pooled connection is replaced
+        "pool_recycle": 1800,
+        # Milliseconds before a statement is cancelled, 0 to disable
+        "statement_timeout": 30000,
+    },
+}
+
+PRAGMA_CHOICES = {
+    "journal_mode": ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"),
+    "synchronous": ("OFF", "NORMAL", "FULL", "EXTRA"),
+}
+
+
+def profile_name(config: Mapping) -> str:
+    "The profile to use, resolving 'auto' from the database URI"
+    if config["DB_PROFILE"] != "auto":
+        return config["DB_PROFILE"]
+    backend = make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name()
+    return backend if backend in PROFILES else "none"
+
+
+def profile_settings(config: Mapping) -> dict:
+    return PROFILES[profile_name(config)] | config["DB_PROFILE_SETTINGS"]
+
+
+def validate_profile(config: Mapping):
+    assert config["DB_PROFILE"] in ("auto", *PROFILES), "Invalid database profile given in config"
+    name = profile_name(config)
+    if name != "none":
+        backend = make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name()
+        assert backend == name, f"Database profile {name} does not match the database URI"
+
+    defaults = PROFILES[name]
+    for key, value in config["DB_PROFILE_SETTINGS"].items():
+        assert key in defaults, f"Unknown database profile setting {key} given in config"
+        assert type(value) is type(defaults[key]), f"Invalid {key} given in config"
+        if key in PRAGMA_CHOICES:
+            assert value.upper() in PRAGMA_CHOICES[key], f"Invalid {key} given in config"
+        elif isinstance(value, int) and not isinstance(value, bool):
+            assert value >= 0, f"Invalid {key} given in config"
+
+    if config["READ_REPLICA_URI"]:
+        backend = make_url(config["READ_REPLICA_URI"]).get_backend_name()
+        assert backend == make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name(), (
+            "Read replica must use the same database type as the primary"
+        )
+
+
+def sqlite_pragmas(settings: dict, pragmas: tuple[str, ...]):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}={settings[pragma]}")
+        cursor.close()
+
+    return on_connect
+
+
+def engine_options(app: Flask) -> dict:
+    "Engine options for the configured profile, below any set in SQLALCHEMY_ENGINE_OPTIONS"
+    settings = profile_settings(app.config)
+    options = {}
+    if profile_name(app.config) == "postgresql":
+        options = {
+            key: settings[key]
+            for key in ("pool_size", "max_overflow", "pool_pre_ping", "pool_recycle")
+        }
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={settings['statement_timeout']}"
+        }
+    return options | app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+
+
+def init_app(app: Flask):
+    "Apply the database profile; must run before db.init_app creates the engine"
+    options = engine_options(app)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    if app.config["READ_REPLICA_URI"]:
+        binds = app.config.setdefault("SQLALCHEMY_BINDS", {})
+        binds[REPLICA] = {**options, "url": app.config["READ_REPLICA_URI"]}
+
+
+def init_engines(app: Flask, engines: Mapping):
+    "Hook the profile into the engines created by Flask-SQLAlchemy"
+    if profile_name(app.config) != "sqlite":
+        return
+    settings = profile_settings(app.config)
+    event.listen(
+        engines[None],
+        "connect",
+        sqlite_pragmas(settings, ("journal_mode", "busy_timeout", "synchronous", "mmap_size")),
+    )
+    if REPLICA in engines:
+        # The journal mode can't be changed through a read-only connection
+        event.listen(
+            engines[REPLICA], "connect", sqlite_pragmas(settings, ("busy_timeout", "mmap_size"))
+        )
+
+
+def read_replica(func):
+    "Run the queries of a report view on the read replica, if one is configured"
+
+    @functools.wraps(func)
+    def decorated_view(*args, **kwargs):
+        g.read_replica = True
+        return func(*args, **kwargs)
+
+    return decorated_view
+
+
+class RoutingSession(Session):
+    """Session that sends SELECTs from @read_replica views to the replica.
+
+    Writes, flushes and reads in a session with pending changes stay on the
+    primary, so the scan path and anything that reads its own writes is unaffected.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and isinstance(clause, Select)
+            and has_app_context()
+            and g.get("read_replica")
+            and REPLICA in self._db.engines
+            and not (self._flushing or self.new or self.dirty or self.deleted)
+        ):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -1,4 +1,6 @@
-from datetime import datetime
+import hashlib
+import time
+from datetime import UTC, datetime
 from http import HTTPStatus
 
 import flask_excel as excel
@@ -15,13 +17,19 @@ from flask import (
 )
 from flask.templating import render_template
 from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.future import select
 
-from .model import Active, Event, EventType, Stamps, Subteam, User, db
-from .util import correct_time_for_storage, correct_time_from_storage
+from .database import read_replica
+from .model import Active, Event, EventType, ProcessedScan, Stamps, Subteam, User, db
+from .qr import event_url
+from .util import correct_time_for_storage, correct_time_from_storage, running_async
 
 eventbp = Blueprint("event", __name__)
 
+# Largest number of queued scans a kiosk may upload at once
+MAX_SCAN_BATCH = 500
+
 
 @eventbp.route("/event")
 @login_required
@@ -33,7 +41,13 @@ def event():
     if not event_code or not Event.get_from_code(event_code):
         flash("Invalid event code")
         return redirect(url_for("index"))
-    return render_template("event.html.jinja2", url_base=request.host_url, event_code=event_code)
+    return render_template(
+        "event.html.jinja2",
+        url_base=request.host_url,
+        event_code=event_code,
+        self_url=event_url(event_code),
+        long_poll=running_async(),
+    )
 
 
 @eventbp.route("/event/self")
@@ -50,6 +64,12 @@ def selfevent():
         return redirect(url_for("index"))
 
     if not current_user.is_signed_into(ev):
+        now = datetime.now(tz=UTC).replace(tzinfo=None)
+        if not current_app.config["ALLOW_OVERLAPPING_SIGNINS"] and (
+            other := ev.overlapping_event(current_user, now)
+        ):
+            flash(f"Already signed into {other.name}, sign out there first")
+            return redirect(url_for("index"))
         ev.sign_in(current_user)
 
     return render_template("selfscan.html.jinja2", event=ev, event_code=ev.code)
@@ -113,6 +133,133 @@ def scan():
     )
 
 
+def valid_scan(scan) -> bool:
+    return (
+        isinstance(scan, dict)
+        and isinstance(scan.get("scan_id"), str)
+        and 0 < len(scan["scan_id"]) <= 64
+        and isinstance(scan.get("user_code"), str)
+        and isinstance(scan.get("event_code"), str)
+        and isinstance(scan.get("timestamp"), int | float)
+    )
+
+
+def apply_queued_scan(scan: dict, users: dict[str, User], events: dict[str, Event]) -> str:
+    "Apply one scan from a kiosk queue, returning a message describing the result"
+    scanned = datetime.fromtimestamp(scan["timestamp"] / 1000, tz=UTC)
+    # Don't trust a kiosk clock that runs ahead of ours
+    scanned = min(scanned, datetime.now(tz=UTC))
+
+    user = users.get(scan["user_code"])
+    ev = events.get(scan["event_code"])
+    if not user:
+        return "Error: User does not exist"
+    if not user.approved:
+        return "Error: User is not approved"
+    if not ev:
+        return "Error: Invalid event code"
+    if not ev.adjusted_start <= scanned <= ev.adjusted_end:
+        return "Error: Event was not active"
+
+    stamp = ev.scan(user, scanned.replace(tzinfo=None), commit=False)
+    return f"{stamp.name} signed {stamp.event}"
+
+
+@eventbp.route("/scan/batch", methods=["POST"])
+@login_required
+def scan_batch():
+    """Apply scans that a kiosk queued while offline, in order and in one transaction.
+
+    This function returns a JSON object, not a web page.
+    Each scan has an id generated by the kiosk, so uploading a batch again
+    after a lost response doesn't sign anybody in or out twice.
+    """
+
+    if not current_user.role.can_display:
+        return Response(
+            "Error: User does not have permission to view active stamps",
+            HTTPStatus.FORBIDDEN,
+        )
+
+    scans = (request.get_json(silent=True) or {}).get("scans")
+    if not isinstance(scans, list):
+        return Response("Error: Expected a list of scans", HTTPStatus.BAD_REQUEST)
+    if len(scans) > MAX_SCAN_BATCH:
+        return Response(
+            f"Error: At most {MAX_SCAN_BATCH} scans can be sent at once",
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        )
+    # A malformed scan is answered with an error of its own, so the kiosk can drop it
+    # without holding back the scans queued after it
+    valid = [scan for scan in scans if valid_scan(scan)]
+
+    # Look up the users, events and earlier uploads once rather than per scan
+    processed = dict(
+        db.session.execute(
+            select(ProcessedScan.scan_id, ProcessedScan.result).where(
+                ProcessedScan.scan_id.in_({scan["scan_id"] for scan in valid})
+            )
+        ).all()
+    )
+    users = {
+        user.code: user
+        for user in db.session.scalars(
+            select(User).where(User.code.in_({scan["user_code"] for scan in valid}))
+        )
+    }
+    events = {
+        ev.code: ev
+        for ev in db.session.scalars(
+            select(Event).where(Event.code.in_({scan["event_code"] for scan in valid}))
+        )
+    }
+
+    results = []
+    for scan in scans:
+        if not valid_scan(scan):
+            results.append(
+                {
+                    "scan_id": scan.get("scan_id") if isinstance(scan, dict) else None,
+                    "duplicate": False,
+                    "message": f"Error: Not a valid scan: {scan}",
+                }
+            )
+            continue
+        if scan["scan_id"] in processed:
+            results.append(
+                {
+                    "scan_id": scan["scan_id"],
+                    "duplicate": True,
+                    "message": processed[scan["scan_id"]],
+                }
+            )
+            continue
+        message = apply_queued_scan(scan, users, events)
+        user, ev = users.get(scan["user_code"]), events.get(scan["event_code"])
+        db.session.add(
+            ProcessedScan(
+                scan_id=scan["scan_id"],
+                user_id=user.id if user else None,
+                event_id=ev.id if ev else None,
+                scanned=datetime.fromtimestamp(scan["timestamp"] / 1000, tz=UTC).replace(
+                    tzinfo=None
+                ),
+                result=message,
+            )
+        )
+        processed[scan["scan_id"]] = message
+        results.append({"scan_id": scan["scan_id"], "duplicate": False, "message": message})
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request is applying the same scans, so let the kiosk retry later
+        db.session.rollback()
+        return Response("Error: Scans are already being processed", HTTPStatus.CONFLICT)
+
+    return jsonify({"results": results})
+
+
 @eventbp.route("/autoevent")
 def autoevent():
     """This function returns a JSON object, not a web page."""
@@ -159,6 +306,62 @@ def active():
     )
 
 
+def active_version(ev: Event) -> str:
+    """Fingerprint of the users signed into an event.
+
+    Counts and ids alone can repeat, since SQLite hands out a deleted highest
+    id again, so it covers who is signed in and since when.
+    """
+    rows = db.session.execute(
+        select(Active.user_id, Active.start)
+        .where(Active.event_id == ev.id)
+        .order_by(Active.user_id)
+    )
+    digest = hashlib.sha1(usedforsecurity=False)
+    for user_id, start in rows:
+        digest.update(f"{user_id}@{start.isoformat()};".encode())
+    return digest.hexdigest()
+
+
+@eventbp.route("/active/wait")
+@login_required
+def active_wait():
+    """Long-poll for changes to the users signed into an event.
+
+    This function returns a JSON object, not a web page.
+    The request is held open until the active users differ from `version`,
+    so only use it under the cooperative workers (see gunicorn.conf.py).
+    Under sync workers it answers immediately, like /active.
+    """
+    if not current_user.role.can_display:
+        return Response(
+            "Error: User does not have permission to view active stamps",
+            HTTPStatus.FORBIDDEN,
+        )
+
+    if not (ev := Event.get_from_code(request.values.get("event"))):
+        return Response("Error: Invalid event code", HTTPStatus.NOT_FOUND)
+
+    since = request.values.get("version")
+    timeout = current_app.config["KIOSK_WAIT_TIMEOUT"] if running_async() else 0
+    deadline = time.monotonic() + timeout
+    while (version := active_version(ev)) == since and time.monotonic() < deadline:
+        # Don't hold a transaction open while sleeping
+        db.session.rollback()
+        time.sleep(current_app.config["KIOSK_WAIT_INTERVAL"])
+
+    if not ev.is_active:
+        return jsonify({"action": "redirect"})
+
+    return jsonify(
+        {
+            "users": [active.as_dict() for active in ev.active],
+            "action": "update",
+            "version": version,
+        }
+    )
+
+
 def export_stamps(
     user: User | None = None,
     start: datetime | None = None,
@@ -198,6 +401,7 @@ def export_stamps(
 
 @eventbp.route("/export")
 @login_required
+@read_replica
 def export():
     if current_user.role.admin:
         name = request.values.get("name", current_user.email)
@@ -214,6 +418,7 @@ def export():
 
 @eventbp.route("/export/subteam")
 @login_required
+@read_replica
 def export_subteam():
     if not current_user.can_see_subteam or not current_user.subteam_id:
         return current_app.login_manager.unauthorized()
@@ -1,9 +1,22 @@
+import itertools
+import math
 from collections import defaultdict
 from datetime import UTC, date, datetime, timedelta
+from http import HTTPStatus
 from urllib import parse
 
 from dateutil.rrule import WEEKLY, rrule
-from flask import Blueprint, Flask, flash, redirect, request, url_for
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    request,
+    url_for,
+)
 from flask.templating import render_template
 from flask_login import current_user, login_required
 from flask_wtf import FlaskForm
@@ -27,10 +40,14 @@ from wtforms import (
 )
 from wtforms.validators import DataRequired, EqualTo, NumberRange, ValidationError
 
+from .database import read_replica
 from .model import (
+    Active,
     Event,
     EventRegistration,
     EventType,
+    Stamps,
+    User,
     db,
     gen_code,
     get_form_ids,
@@ -47,6 +64,9 @@ DATE_FORMATS = [
     "%Y-%m-%dT%H:%M",
 ]
 
+# Slots of an occupancy timeline are widened to keep to this many
+MAX_OCCUPANCY_SLOTS = 1000
+
 WEEKDAYS = [
     "Monday",
     "Tuesday",
@@ -153,6 +173,7 @@ def list_events():
 
 @bp.route("/previous")
 @mentor_required
+@read_replica
 def previous():
     events: list[Event] = list(
         db.session.scalars(select(Event).order_by(Event.start).where(Event.end <= func.now()))
@@ -211,18 +232,108 @@ def list_open():
     return render_template("open_events.html.jinja2", events=events)
 
 
+def occupancy(
+    event: Event, resolution: timedelta
+) -> tuple[list[tuple[datetime, int]], int, datetime | None, timedelta]:
+    """Headcount of an event over time, in one sweep over its sign in and out times.
+
+    Returns the most users signed in during each `resolution` long slot, then the
+    peak headcount and when it was first reached. Times are as stored, in UTC.
+    Users still signed in count until now or the end of the event, and slots are
+    widened to whole minutes if the timeline would have over MAX_OCCUPANCY_SLOTS,
+    so the resolution used is returned too.
+    """
+    now = datetime.now(tz=UTC).replace(tzinfo=None)
+    # A forgotten sign out shouldn't stretch the timeline past the event
+    open_until = min(
+        now, event.end + timedelta(minutes=current_app.config["POST_EVENT_ACTIVE_TIME"])
+    )
+    points = []
+    for start, end in db.session.execute(
+        select(Stamps.start, Stamps.end).where(Stamps.event_id == event.id)
+    ):
+        points += [(start, 1), (end, -1)]
+    for start in db.session.scalars(select(Active.start).where(Active.event_id == event.id)):
+        points += [(start, 1), (max(start, open_until), -1)]
+    if not points:
+        return [], 0, None, resolution
+
+    points.sort()
+    span = points[-1][0] - points[0][0]
+    minutes = math.ceil(span / timedelta(minutes=1) / MAX_OCCUPANCY_SLOTS)
+    resolution = max(resolution, timedelta(minutes=minutes))
+    slot = datetime.min + (points[0][0] - datetime.min) // resolution * resolution
+    timeline = []
+    count = slot_peak = peak = 0
+    peak_time = None
+    # Changes at the same time are applied together, so back to back stamps don't count twice
+    for time, changes in itertools.groupby(points, key=lambda point: point[0]):
+        while time >= slot + resolution:
+            timeline.append((slot, slot_peak))
+            slot += resolution
+            slot_peak = count
+        count += sum(change for _, change in changes)
+        slot_peak = count if time == slot else max(slot_peak, count)
+        if count > peak:
+            peak, peak_time = count, time
+    timeline.append((slot, slot_peak))
+    return timeline, peak, peak_time, resolution
+
+
+@bp.route("/stats/occupancy")
+@mentor_required
+@read_replica
+def stats_occupancy():
+    """Headcount over time for an event.
+
+    This function returns a JSON object, not a web page.
+    `resolution` is the length of each slot in minutes, which the reply gives as
+    widened if the timeline would have too many slots.
+    """
+    if not (event := db.session.get(Event, request.args.get("event_id", type=int))):
+        return Response("Error: Invalid event", HTTPStatus.NOT_FOUND)
+    resolution = request.args.get(
+        "resolution", current_app.config["OCCUPANCY_RESOLUTION"], type=int
+    )
+    if not 1 <= resolution <= 24 * 60:
+        return Response("Error: Resolution must be 1 to 1440 minutes", HTTPStatus.BAD_REQUEST)
+
+    timeline, peak, peak_time, used = occupancy(event, timedelta(minutes=resolution))
+    return jsonify(
+        {
+            "event": event.id,
+            "resolution": used // timedelta(minutes=1),
+            "peak": {
+                "count": peak,
+                "time": peak_time and correct_time_from_storage(peak_time).isoformat(),
+            },
+            "timeline": [
+                {"time": correct_time_from_storage(time).isoformat(), "count": count}
+                for time, count in timeline
+            ],
+        }
+    )
+
+
 @bp.route("/stats")
 @mentor_required
+@read_replica
 def stats():
     event: Event = db.session.get(Event, request.args["event_id"])
     users = defaultdict(timedelta)
     subteams = defaultdict(timedelta)
     blocks = defaultdict(list)
     total_time = timedelta()
-    for stamp in event.stamps:
-        users[stamp.user] += stamp.elapsed
-        subteams[stamp.user.subteam] += stamp.elapsed
-        total_time += stamp.elapsed
+    user_totals = db.session.execute(
+        select(User, func.sum(Stamps.duration_seconds))
+        .join(Stamps, Stamps.user_id == User.id)
+        .where(Stamps.event_id == event.id)
+        .group_by(User.id)
+    )
+    for user, seconds in user_totals:
+        users[user] += timedelta(seconds=seconds)
+        subteams[user.subteam] += timedelta(seconds=seconds)
+        total_time += timedelta(seconds=seconds)
     now = datetime.now(tz=UTC)
     for active in event.active:
         users[active.user] += now - correct_time_from_storage(active.start)
@@ -247,6 +358,9 @@ def stats():
     registration_url = parse.urljoin(
         request.host_url, url_for("events.register", event_id=event.id)
     )
+    _, peak, peak_time, _ = occupancy(
+        event, timedelta(minutes=current_app.config["OCCUPANCY_RESOLUTION"])
+    )
     return render_template(
         "event_stats.html.jinja2",
         event=event,
@@ -255,6 +369,8 @@ def stats():
         blocks=blocks,
         registration_url=registration_url,
         total_time=total_time,
+        peak=peak,
+        peak_time=peak_time and correct_time_from_storage(peak_time).strftime("%c"),
     )
 
 
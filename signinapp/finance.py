@@ -2,6 +2,7 @@
 from flask import Blueprint, Flask, render_template
 from sqlalchemy.future import select
 
+from .database import read_replica
 from .model import Event, Role, User, db
 from .util import admin_required
 
@@ -10,6 +11,7 @@ finance = Blueprint("finance", __name__)
 
 @finance.route("/finance")
 @admin_required
+@read_replica
 def overview():
     all_events: list[Event] = db.session.scalars(select(Event))
     all_users: list[User] = db.session.scalars(
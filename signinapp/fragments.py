@@ -0,0 +1,178 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+
+from flask import Flask, current_app, g, has_app_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .changes import Change, changed_tables, subscribe
+
+# Writes to these tables invalidate every cached fragment: the time fragments read
+# stamps, events and event types, and funds also depend on roles and whose role is what
+TABLES = ("stamps", "events", "event_types", "badge_awards", "badges", "account_types", "users")
+
+
+class MemoryBackend:
+    "Least recently used fragments of this worker"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.generations = dict.fromkeys(TABLES, 0)
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: str, ttl: float):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def generation(self) -> str:
+        return "-".join(str(self.generations[table]) for table in TABLES)
+
+    def bump(self, tables: Iterable[str]):
+        with self.lock:
+            for table in tables:
+                self.generations[table] += 1
+
+
+class FileBackend:
+    """Fragments shared by every worker through a directory.
+
+    Each fragment is a file whose mtime is its expiry time. The generation of
+    each table is a random token in its own file, so concurrent bumps from
+    different workers can't be lost.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.join(path, "generations"), exist_ok=True)
+
+    def write(self, path: str, value: str, expires: float | None = None):
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, "w") as f:
+            f.write(value)
+        if expires is not None:
+            os.utime(tmp, (expires, expires))
+        os.replace(tmp, path)
+
+    def fragment_path(self, key: str) -> str:
+        return os.path.join(self.path, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key: str) -> str | None:
+        path = self.fragment_path(key)
+        try:
+            if os.stat(path).st_mtime < time.time():
+                return None
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: str, ttl: float):
+        self.write(self.fragment_path(key), value, time.time() + ttl)
+        if secrets.randbelow(100) == 0:
+            self.prune()
+
+    def prune(self):
+        "Remove expired fragments"
+        now = time.time()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < now:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def generation(self) -> str:
+        tokens = []
+        for table in TABLES:
+            try:
+                with open(os.path.join(self.path, "generations", table)) as f:
+                    tokens.append(f.read())
+            except FileNotFoundError:
+                tokens.append("0")
+        return "-".join(tokens)
+
+    def bump(self, tables: Iterable[str]):
+        for table in tables:
+            self.write(os.path.join(self.path, "generations", table), secrets.token_hex(8))
+
+
+class FragmentCacheExtension(Extension):
+    """Cache the rendered body of a block.
+
+    {% cache "profile-time-" ~ user.id, 600 %}...{% endcache %}
+
+    The key is combined with the generation of TABLES, so any change to them
+    renders the block again. The second argument is the lifetime in seconds.
+    """
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cache", args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, caller):
+        backend = current_app.extensions.get("fragment_cache")
+        if backend is None:
+            return caller()
+
+        if "fragment_generation" not in g:
+            g.fragment_generation = backend.generation()
+        key = f"{key}@{g.fragment_generation}"
+        if (value := backend.get(key)) is not None:
+            return Markup(value)
+
+        value = caller()
+        backend.set(key, str(value), ttl or current_app.config["FRAGMENT_CACHE_TTL"])
+        return value
+
+
+def init_app(app: Flask):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    if app.config["FRAGMENT_CACHE"] == "memory":
+        app.extensions["fragment_cache"] = MemoryBackend(app.config["FRAGMENT_CACHE_SIZE"])
+    elif app.config["FRAGMENT_CACHE"] == "filesystem":
+        app.config.setdefault(
+            "FRAGMENT_CACHE_DIR", os.path.join(app.instance_path, "fragment-cache")
+        )
+        app.extensions["fragment_cache"] = FileBackend(app.config["FRAGMENT_CACHE_DIR"])
+    else:
+        return
+
+    backend = app.extensions["fragment_cache"]
+
+    def invalidate(changes: list[Change]):
+        if tables := changed_tables(changes).intersection(TABLES):
+            backend.bump(tables)
+            if has_app_context():
+                g.pop("fragment_generation", None)
+
+    subscribe(app, invalidate)
@@ -1,11 +1,15 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-from flask import current_app
+from flask import Flask, current_app
 from flask_apscheduler import APScheduler
+from sqlalchemy import delete, func
 from sqlalchemy.future import select
 
-from .model import Active, db
+from .model import Active, ProcessedScan, db
+
+# How long applied kiosk scans are remembered, to ignore retried uploads
+SCAN_RETENTION = timedelta(days=7)
 
 # initialize scheduler
 scheduler = APScheduler()
@@ -30,3 +34,18 @@ def EventEndJob():
                     # Delete active entry without crediting the user
                     db.session.delete(active)
         db.session.commit()
+
+
+@scheduler.task("interval", id="PruneScansJob", hours=1)
+def PruneScansJob():
+    "Forget kiosk scans applied longer than SCAN_RETENTION ago"
+    with scheduler.app.app_context():
+        # processed is set by the database, so compare it to the database's clock
+        cutoff = db.session.scalar(select(func.now())) - SCAN_RETENTION
+        db.session.execute(delete(ProcessedScan).where(ProcessedScan.processed < cutoff))
+        db.session.commit()
+
+
+def init_app(app: Flask):
+    scheduler.init_app(app)
+    scheduler.start()
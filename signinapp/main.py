@@ -0,0 +1,49 @@
+from flask import Flask, render_template
+from sqlalchemy.future import select
+
+from .model import Event, db
+
+
+def index():
+    stmt = select(Event).filter_by(is_active=True)
+    events = db.session.scalars(stmt)
+    return render_template("index.html.jinja2", events=events)
+
+
+def page_not_found(e):
+    return (
+        render_template("error.html.jinja2", error_headline="Page Not Found", error_msg=e),
+        404,
+    )
+
+
+def internal_server_error(e: int):
+    return (
+        render_template("error.html.jinja2", error_headline="Internal Error", error_msg=e),
+        500,
+    )
+
+
+def internal_server_error_ex(e: Exception):
+    import io
+    import traceback
+
+    buffer = io.StringIO()
+
+    traceback.print_exception(e)
+    traceback.print_exception(e, file=buffer)
+    return (
+        render_template(
+            "error.html.jinja2",
+            error_headline="Internal Error",
+            error_msg=buffer.getvalue(),
+        ),
+        500,
+    )
+
+
+def init_app(app: Flask):
+    app.add_url_rule("/", view_func=index)
+    app.register_error_handler(404, page_not_found)
+    app.register_error_handler(500, internal_server_error)
+    app.register_error_handler(Exception, internal_server_error_ex)
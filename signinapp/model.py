@@ -7,17 +7,21 @@ import secrets
 from datetime import UTC, date, datetime, timedelta
 from typing import Annotated
 
-from flask import current_app
+from flask import current_app, g, has_app_context
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import MetaData, and_, func
+from sqlalchemy import Integer, MetaData, Select, Table, and_, cast, delete, exists, func
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.associationproxy import AssociationProxy, association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.future import select
-from sqlalchemy.orm import Mapped, mapped_column
-from werkzeug.security import generate_password_hash
+from sqlalchemy.orm import Mapped, mapped_column, validates
+from sqlalchemy.sql.util import find_tables
 from wtforms import FieldList
 
+from .choices import cached_choices
+from .database import RoutingSession
+from .passwords import hash_password
 from .util import (
     correct_time_for_storage,
     correct_time_from_storage,
@@ -37,7 +41,7 @@ convention = {
 metadata = MetaData(naming_convention=convention)
 
 # this variable, db, will be used for all SQLAlchemy commands
-db = SQLAlchemy(metadata=metadata)
+db = SQLAlchemy(metadata=metadata, session_options={"class_": RoutingSession})
 
 intpk = Annotated[int, mapped_column(primary_key=True)]
 NonNullBool = Annotated[bool, mapped_column(default=False)]
@@ -56,17 +60,60 @@ def gen_code():
 
 
 def get_form_ids(model, add_null_id=False, filters=()):
+    "Choices for a select field, cached until a table in the query is written"
     prefix = [(0, "None")] if add_null_id else []
-    stmt = select(model)
+    stmt = select(model.id, model.name)
     if filters:
         stmt = stmt.where(*filters)
-    return prefix + [(x.id, x.name) for x in db.session.scalars(stmt)]
+    key = str(stmt.compile(compile_kwargs={"literal_binds": True}))
+    tables = frozenset(
+        t.name for t in find_tables(stmt, check_columns=True) if isinstance(t, Table)
+    )
+    return prefix + cached_choices(
+        key, tables, lambda: [tuple(row) for row in db.session.execute(stmt)]
+    )
+
+
+def shift_minutes(column, minutes: int):
+    "A datetime column moved by some minutes, in SQL"
+    if db.get_engine().name == "postgresql":
+        return column + func.make_interval(0, 0, 0, 0, 0, minutes)
+    # The same text format SQLAlchemy stores, so the result compares and parses like a column
+    return func.strftime("%Y-%m-%d %H:%M:%f000", column, f"{minutes:+d} minutes", type_=db.DateTime)
+
+
+def seconds_between(start, end):
+    "Whole seconds from one datetime column to another, in SQL"
+    if db.get_engine().name == "postgresql":
+        seconds = func.extract("epoch", end - start)
+    else:
+        seconds = (func.julianday(end) - func.julianday(start)) * 86400
+    return cast(func.round(seconds), Integer)
+
+
+def total_duration(*criteria) -> timedelta:
+    "Total time of the stamps matching `criteria`, which may refer to their event"
+    seconds = db.session.scalar(
+        select(func.coalesce(func.sum(Stamps.duration_seconds), 0))
+        .join(Event, Stamps.event_id == Event.id)
+        .where(*criteria)
+    )
+    return timedelta(seconds=seconds)
+
+
+def dialect_insert(model):
+    "An INSERT for the current database, which supports ON CONFLICT"
+    if db.get_engine().name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
 
 
 @dataclasses.dataclass
 class StampEvent:
     name: str
     event: str
+    # False if the scan was ignored by the debounce
+    changed: bool = True
 
 
 class ShirtSizes(enum.Enum):
@@ -94,6 +141,17 @@ class Pronoun(enum.Enum):
         return [(p.name, p.value) for p in cls]
 
 
+class RuleKind(enum.Enum):
+    Hours = "Hours at events"
+    Events = "Events attended"
+    Subteam = "Member of subteam"
+    Badge = "Has badge"
+
+    @classmethod
+    def get_kind_options(cls):
+        return [(k.name, k.value) for k in cls]
+
+
 class Badge(db.Model):
     'Represents an "achievement", accomplishment, or certification'
 
@@ -106,6 +164,9 @@ class Badge(db.Model):
     color: Mapped[str] = mapped_column(default="black")
 
     awards: Mapped[list[BadgeAward]] = db.relationship(back_populates="badge")
+    rules: Mapped[list[BadgeRule]] = db.relationship(
+        back_populates="badge", cascade="all, delete-orphan", foreign_keys="BadgeRule.badge_id"
+    )
 
     @staticmethod
     def from_name(name) -> Badge:
@@ -113,6 +174,44 @@ class Badge(db.Model):
         return db.session.scalar(select(Badge).filter_by(name=name))
 
 
+class BadgeRule(db.Model):
+    "A condition for awarding a badge automatically, all of a badge's rules must be met"
+
+    __tablename__ = "badge_rules"
+    id: Mapped[intpk]
+    badge_id: Mapped[int] = mapped_column(db.ForeignKey("badges.id", ondelete="CASCADE"))
+    kind: Mapped[RuleKind]
+    # Hours or number of events needed
+    threshold: Mapped[int] = mapped_column(default=0)
+    # Only count events of this type, if set
+    event_type_id: Mapped[int | None] = mapped_column(
+        db.ForeignKey("event_types.id", ondelete="CASCADE")
+    )
+    # Only count events of the current school year
+    current_year: Mapped[bool] = mapped_column(default=True)
+    subteam_id: Mapped[int | None] = mapped_column(db.ForeignKey("subteams.id", ondelete="CASCADE"))
+    required_badge_id: Mapped[int | None] = mapped_column(
+        db.ForeignKey("badges.id", ondelete="CASCADE")
+    )
+
+    badge: Mapped[Badge] = db.relationship(back_populates="rules", foreign_keys=[badge_id])
+    event_type: Mapped[EventType | None] = db.relationship()
+    subteam: Mapped[Subteam | None] = db.relationship()
+    required_badge: Mapped[Badge | None] = db.relationship(foreign_keys=[required_badge_id])
+
+    @property
+    def description(self) -> str:
+        if self.kind == RuleKind.Subteam:
+            return f"Member of {self.subteam.name}"
+        if self.kind == RuleKind.Badge:
+            return f"Has the {self.required_badge.name} badge"
+        events = f"{self.event_type.name} events" if self.event_type else "events"
+        when = " this school year" if self.current_year else ""
+        if self.kind == RuleKind.Hours:
+            return f"{self.threshold} hours at {events}{when}"
+        return f"{self.threshold} {events}{when}"
+
+
 class BadgeAward(db.Model):
     "Represents a pairing of user to badge, with received date"
 
@@ -133,10 +232,22 @@ parent_child_association_table = db.Table(
     "parent_child_association",
     db.metadata,
     db.Column("guardians", db.ForeignKey("guardians.id"), primary_key=True),
-    db.Column("user_id", db.ForeignKey("students.id"), primary_key=True),
+    # Indexed on its own for looking up a student's guardians, the primary key covers the reverse
+    db.Column("user_id", db.ForeignKey("students.id"), primary_key=True, index=True),
 )
 
 
+def guardian_links(*criteria) -> Select:
+    "Guardian and student user ids of the parent/child links matching `criteria`, in one join"
+    return (
+        select(Guardian.user_id, Student.user_id)
+        .select_from(parent_child_association_table)
+        .join(Guardian, Guardian.id == parent_child_association_table.c.guardians)
+        .join(Student, Student.id == parent_child_association_table.c.user_id)
+        .where(*criteria)
+    )
+
+
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id: Mapped[intpk]
@@ -192,10 +303,7 @@ class User(UserMixin, db.Model):
     def yearly_time(self, year: int | None = None) -> timedelta:
         "Total time for all stamps in a year"
         year = year or school_year_for_date(date.today())
-        return sum(
-            (s.elapsed for s in self.stamps if s.event.school_year == year),
-            start=timedelta(),
-        )
+        return total_duration(Stamps.user_id == self.id, Event.school_year == year)
 
     @property
     def formatted_phone_number(self) -> str:
@@ -220,9 +328,9 @@ class User(UserMixin, db.Model):
 
     def total_stamps_for(self, type_: EventType, year: int | None = None) -> timedelta:
         "Total time for an event type"
-        return sum(
-            (s.elapsed for s in self.stamps_for(type_, year)),
-            start=timedelta(),
+        year = year or school_year_for_date(date.today())
+        return total_duration(
+            Stamps.user_id == self.id, Event.type_id == type_.id, Event.school_year == year
         )
 
     def stamps_for_event(self, event: Event) -> list[Stamps]:
@@ -231,17 +339,32 @@ class User(UserMixin, db.Model):
 
     def can_view(self, user: User):
         "Whether the user in question can view this user"
-        return (
-            self.role.mentor
-            or self.role.admin
-            or (self == user)
-            or (
-                self.guardian_user_data
-                and user.student_user_data
-                and user.student_user_data in self.guardian_user_data.students
-            )
+        if self.role.mentor or self.role.admin or self == user:
+            return True
+        # Remembered for the rest of the request, since pages check the same users repeatedly
+        memo = g.setdefault("can_view", {}) if has_app_context() else {}
+        if (self.id, user.id) not in memo:
+            memo[self.id, user.id] = self.is_guardian_of(user)
+        return memo[self.id, user.id]
+
+    def is_guardian_of(self, user: User) -> bool:
+        return db.session.scalar(
+            select(guardian_links(Guardian.user_id == self.id, Student.user_id == user.id).exists())
         )
 
+    @property
+    def children(self) -> list[User]:
+        "The students this user is a guardian of"
+        return db.session.scalars(
+            select(User)
+            .where(
+                User.id.in_(
+                    guardian_links(Guardian.user_id == self.id).with_only_columns(Student.user_id)
+                )
+            )
+            .order_by(User.name)
+        ).all()
+
     @property
     def human_readable(self) -> str:
         "Human readable string for display on a web page"
@@ -304,7 +427,7 @@ class User(UserMixin, db.Model):
         user = User(
             email=email,
             name=name,
-            password=generate_password_hash(password),
+            password=hash_password(password),
             role_id=role.id,
             subteam_id=subteam.id if subteam else None,
             approved=approved,
@@ -349,7 +472,7 @@ class Guardian(db.Model):
 
     __tablename__ = "guardians"
     id: Mapped[intpk]
-    user_id: Mapped[int] = mapped_column(db.ForeignKey("users.id"))
+    user_id: Mapped[int] = mapped_column(db.ForeignKey("users.id"), index=True)
     contact_order: Mapped[int]
 
     # One to One: Links User to row in Guardian table
@@ -377,7 +500,7 @@ class Guardian(db.Model):
 class Student(db.Model):
     __tablename__ = "students"
     id: Mapped[intpk]
-    user_id: Mapped[int] = mapped_column(db.ForeignKey("users.id"))
+    user_id: Mapped[int] = mapped_column(db.ForeignKey("users.id"), index=True)
 
     # Extra student information
     graduation_year: Mapped[int]
@@ -501,16 +624,26 @@ class Event(db.Model):
         "Get the net funds in a human readable format"
         return locale.currency(self.net_funds / 100.0)
 
-    @property
+    @hybrid_property
     def adjusted_start(self) -> datetime:
         start = correct_time_from_storage(self.start)
         return start - timedelta(minutes=current_app.config["PRE_EVENT_ACTIVE_TIME"])
 
-    @property
+    @adjusted_start.expression
+    def adjusted_start(cls):
+        "Usable in queries, as a stored (UTC) time"
+        return shift_minutes(cls.start, -current_app.config["PRE_EVENT_ACTIVE_TIME"])
+
+    @hybrid_property
     def adjusted_end(self) -> datetime:
         end = correct_time_from_storage(self.end)
         return end + timedelta(minutes=current_app.config["POST_EVENT_ACTIVE_TIME"])
 
+    @adjusted_end.expression
+    def adjusted_end(cls):
+        "Usable in queries, as a stored (UTC) time"
+        return shift_minutes(cls.end, current_app.config["POST_EVENT_ACTIVE_TIME"])
+
     @hybrid_property
     def is_active(self) -> bool:
         "Test for if the event is currently active"
@@ -520,23 +653,9 @@ class Event(db.Model):
     @is_active.expression
     def is_active(cls):
         "Usable in queries"
-        if db.get_engine().name == "postgresql":
-            pre_adj = cls.start - func.make_interval(
-                0, 0, 0, 0, 0, current_app.config["PRE_EVENT_ACTIVE_TIME"]
-            )
-            post_adj = cls.end + func.make_interval(
-                0, 0, 0, 0, 0, current_app.config["POST_EVENT_ACTIVE_TIME"]
-            )
-        elif db.get_engine().name == "sqlite":
-            pre_adj = func.datetime(
-                cls.start,
-                f"-{current_app.config['PRE_EVENT_ACTIVE_TIME']} minutes",
-            )
-            post_adj = func.datetime(
-                cls.end,
-                f"+{current_app.config['POST_EVENT_ACTIVE_TIME']} minutes",
-            )
-        return and_((pre_adj < func.now()), (post_adj > func.now())).label("is_active")
+        return and_(cls.adjusted_start < func.now(), cls.adjusted_end > func.now()).label(
+            "is_active"
+        )
 
     @hybrid_property
     def school_year(self) -> int:
@@ -548,22 +667,21 @@ class Event(db.Model):
         if db.get_engine().name == "postgresql":
             adj_date = func.extract("year", cls.start + func.make_interval(0, 6))
         elif db.get_engine().name == "sqlite":
-            adj_date = func.datetime(cls.start, "+6 months", "year")
+            adj_date = cast(func.strftime("%Y", cls.start, "+6 months"), Integer)
         return adj_date.label("school_year")
 
     @property
     def total_time(self) -> timedelta:
-        return sum((s.elapsed for s in self.stamps), start=timedelta())
+        return total_duration(Stamps.event_id == self.id)
 
     def raw_funds_for(self, user: User) -> float:
         "Calculate funds from an event for the given user"
         if not user.role.receives_funds:
             return 0.0
-        user_stamps = user.stamps_for_event(self)
-        user_hours = sum((stamp.elapsed for stamp in user_stamps), start=timedelta())
-        total_hours = sum(
-            (stamp.elapsed for stamp in self.stamps if stamp.user.role.receives_funds),
-            start=timedelta(),
+        user_hours = total_duration(Stamps.event_id == self.id, Stamps.user_id == user.id)
+        total_hours = total_duration(
+            Stamps.event_id == self.id,
+            Stamps.user.has(User.role.has(receives_funds=True)),
         )
         user_proportion = (user_hours / total_hours) if total_hours else 0.0
         return user_proportion * (1 - self.overhead) * self.net_funds / 100.0
@@ -575,22 +693,89 @@ class Event(db.Model):
     def overhead_funds(self) -> str:
         return locale.currency(self.net_funds * self.overhead / 100.0)
 
-    def scan(self, user: User) -> StampEvent:
-        active: Active | None = db.session.scalar(select(Active).filter_by(user=user, event=self))
-        if active:
-            stamp = active.convert_to_stamp()
-            # Elapsed needs to be taken after committing to the DB
-            # otherwise it won't be populated
-            sign = f"out after {stamp.elapsed}"
-            return StampEvent(user.human_readable, sign)
+    def signed_out_since(self, user: User, since: datetime) -> bool:
+        return db.session.scalar(
+            select(
+                exists().where(
+                    Stamps.user_id == user.id, Stamps.event_id == self.id, Stamps.end > since
+                )
+            )
+        )
+
+    def overlapping_event(self, user: User, when: datetime) -> Event | None:
+        "Another event the user is signed into at `when`"
+        return db.session.scalar(
+            select(Event)
+            .join(Active, Active.event_id == Event.id)
+            .where(Active.user_id == user.id, Active.event_id != self.id, Active.start <= when)
+            # Until the scheduler signs them out, users stay active in events that have ended
+            .where(Event.adjusted_end > when)
+            .limit(1)
+        ) or db.session.scalar(
+            select(Event)
+            .join(Stamps, Stamps.event_id == Event.id)
+            .where(
+                Stamps.user_id == user.id,
+                Stamps.event_id != self.id,
+                Stamps.start <= when,
+                Stamps.end > when,
+            )
+            .limit(1)
+        )
+
+    def scan(self, user: User, when: datetime | None = None, commit=True) -> StampEvent:
+        """Toggle a user in or out of the event.
+
+        Signing out is a DELETE ... RETURNING and signing in an INSERT ... ON CONFLICT
+        against the unique (user, event) constraint on active, so simultaneous scans
+        can't sign a user in twice. Scans within SCAN_DEBOUNCE_SECONDS of the last
+        toggle are ignored. `when` is the time of the scan if it isn't now.
+        Unless ALLOW_OVERLAPPING_SIGNINS is set, users signed into another event
+        aren't signed in, since the overlapping time would count twice.
+        """
+        if when is None:
+            when = datetime.now(tz=UTC).replace(tzinfo=None)
+        debounce = when - timedelta(seconds=current_app.config["SCAN_DEBOUNCE_SECONDS"])
+
+        start = db.session.scalar(
+            delete(Active)
+            .where(Active.user_id == user.id, Active.event_id == self.id, Active.start <= debounce)
+            .returning(Active.start)
+        )
+        if start is not None:
+            stamp = Stamps(user=user, event=self, start=start, end=when)
+            db.session.add(stamp)
+            result = StampEvent(user.human_readable, f"out after {stamp.elapsed}")
+        elif self.signed_out_since(user, debounce):
+            result = StampEvent(user.human_readable, "out", changed=False)
+        elif not current_app.config["ALLOW_OVERLAPPING_SIGNINS"] and (
+            other := self.overlapping_event(user, when)
+        ):
+            message = f"into {other.name} already, sign out there first"
+            result = StampEvent(user.human_readable, message, changed=False)
+        elif self.sign_in(user, when, commit=False):
+            result = StampEvent(user.human_readable, "in")
         else:
-            self.sign_in(user)
-            return StampEvent(user.human_readable, "in")
+            # Already signed in within the debounce window
+            result = StampEvent(user.human_readable, "in", changed=False)
 
-    def sign_in(self, user: User):
-        active = Active(user=user, event=self)
-        db.session.add(active)
-        db.session.commit()
+        if commit:
+            db.session.commit()
+        return result
+
+    def sign_in(self, user: User, when: datetime | None = None, commit=True) -> bool:
+        "Sign a user in, returning False if they already were"
+        values = {"user_id": user.id, "event_id": self.id}
+        if when is not None:
+            values["start"] = when
+        inserted = db.session.execute(
+            dialect_insert(Active)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["user_id", "event_id"])
+        ).rowcount
+        if commit:
+            db.session.commit()
+        return inserted > 0
 
     @staticmethod
     def create(
@@ -644,6 +829,8 @@ class EventType(db.Model):
 
 class Active(db.Model):
     __tablename__ = "active"
+    # Scans rely on this to never sign a user into an event twice
+    __table_args__ = (db.UniqueConstraint("user_id", "event_id"),)
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(db.ForeignKey("users.id"))
     event_id: Mapped[int] = mapped_column(db.ForeignKey("events.id"))
@@ -665,36 +852,84 @@ class Active(db.Model):
             "event": self.event.name,
         }
 
-    def convert_to_stamp(self: Active, end: datetime | None = None):
-        stamp = Stamps(
-            user=self.user,
-            event=self.event,
-            start=self.start,
+    def convert_to_stamp(self: Active, end: datetime | None = None, commit=True) -> Stamps | None:
+        """Replace the active entry with a stamp, returning None if it's already gone.
+
+        The entry is removed with DELETE ... RETURNING, so when a mentor, the
+        scheduler and a scan race to sign the user out only one stamp is made.
+        """
+        if end is None:
+            end = datetime.now(tz=UTC).replace(tzinfo=None)
+        start = db.session.scalar(
+            delete(Active).where(Active.id == self.id).returning(Active.start)
         )
-        if end is not None:
-            stamp.end = end
-        db.session.delete(self)
+        if start is None:
+            return None
+        stamp = Stamps(user_id=self.user_id, event_id=self.event_id, start=start, end=end)
         db.session.add(stamp)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return stamp
 
 
 class Stamps(db.Model):
     __tablename__ = "stamps"
+    __table_args__ = (
+        # Covering indexes, so totals are summed from the index alone
+        db.Index("ix_stamps_user_event_duration", "user_id", "event_id", "duration_seconds"),
+        db.Index("ix_stamps_event_user_duration", "event_id", "user_id", "duration_seconds"),
+    )
     id: Mapped[intpk]
     user_id: Mapped[int] = mapped_column(db.ForeignKey("users.id"))
     event_id: Mapped[int] = mapped_column(db.ForeignKey("events.id"))
     start: Mapped[datetime]
     end: Mapped[datetime] = mapped_column(server_default=func.now())
+    # end - start, kept up to date by set_duration and bulk UPDATEs
+    duration_seconds: Mapped[int] = mapped_column(default=0, server_default="0")
 
     user: Mapped[User] = db.relationship(back_populates="stamps")
     event: Mapped[Event] = db.relationship(back_populates="stamps")
 
+    @validates("start", "end")
+    def set_duration(self, key: str, value: datetime) -> datetime:
+        start, end = (value, self.end) if key == "start" else (self.start, value)
+        if start is not None and end is not None:
+            self.duration_seconds = round((end - start).total_seconds())
+        return value
+
     @hybrid_property
     def elapsed(self) -> timedelta:
         "Elapsed time for a stamp"
         return self.end - self.start
 
+    @hybrid_property
+    def elapsed_seconds(self) -> float:
+        return self.elapsed.total_seconds()
+
+    @elapsed_seconds.expression
+    def elapsed_seconds(cls):
+        "Usable in queries"
+        return cls.duration_seconds
+
+
+class ProcessedScan(db.Model):
+    """A kiosk scan that has been applied, so that retried uploads are ignored.
+
+    Kiosks retry soon after a lost response, so scans are only kept for a
+    week after they're processed, then pruned by PruneScansJob.
+    """
+
+    __tablename__ = "processed_scans"
+    # Generated by the kiosk when the code is read
+    scan_id: Mapped[str] = mapped_column(primary_key=True)
+    user_id: Mapped[int | None] = mapped_column(db.ForeignKey("users.id", ondelete="CASCADE"))
+    event_id: Mapped[int | None] = mapped_column(db.ForeignKey("events.id", ondelete="CASCADE"))
+    # Time the code was read, according to the kiosk
+    scanned: Mapped[datetime]
+    # What happened to the scan, for answering retries
+    result: Mapped[str]
+    processed: Mapped[datetime] = mapped_column(server_default=func.now())
+
 
 class Role(db.Model):
     __tablename__ = "account_types"
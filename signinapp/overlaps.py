@@ -0,0 +1,112 @@
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import delete, update
+from sqlalchemy.future import select
+
+from .model import Event, Stamps, User, db
+
+# Stamps deleted per statement
+DELETE_BATCH = 500
+
+
+class Interval(NamedTuple):
+    stamp_id: int
+    user_id: int
+    event_id: int
+    start: datetime
+    end: datetime
+    user: str
+    event: str
+
+
+class Overlap(NamedTuple):
+    # The stamp reaching furthest so far, which `second` starts inside of
+    first: Interval
+    second: Interval
+    # What was done about it: None, "merged", "clipped" or "removed"
+    action: str | None
+
+
+def intervals(*criteria) -> Iterator[Interval]:
+    "Stamps matching `criteria`, sorted by user and then start, streamed from the database"
+    stmt = (
+        select(
+            Stamps.id,
+            Stamps.user_id,
+            Stamps.event_id,
+            Stamps.start,
+            Stamps.end,
+            User.name,
+            Event.name,
+        )
+        .join(User, Stamps.user_id == User.id)
+        .join(Event, Stamps.event_id == Event.id)
+        .where(*criteria)
+        .order_by(Stamps.user_id, Stamps.start, Stamps.id)
+    )
+    for row in db.session.execute(stmt.execution_options(yield_per=1000)):
+        yield Interval(*row)
+
+
+class OverlapSweep:
+    """Finds overlapping stamps of each user in a single pass over sorted intervals.
+
+    Each stamp is compared with the one reaching furthest so far, so every
+    overlapping stamp is reported once. With `merge`, overlapping stamps of
+    the same event are combined, and with `clip` the later stamp starts when
+    the earlier one ends. The changes are collected for `apply`.
+    """
+
+    def __init__(self, merge=False, clip=False):
+        self.merge = merge
+        self.clip = clip
+        self.updates: dict[int, Interval] = {}
+        self.deletes: list[int] = []
+
+    def run(self, rows: Iterable[Interval]) -> Iterator[Overlap]:
+        latest = None
+        for row in rows:
+            if latest is None or row.user_id != latest.user_id or row.start >= latest.end:
+                latest = row
+                continue
+
+            first = latest
+            if self.merge and row.event_id == latest.event_id:
+                action = "merged"
+                self.deletes.append(row.stamp_id)
+                if row.end > latest.end:
+                    latest = self.updates[latest.stamp_id] = latest._replace(end=row.end)
+            elif self.clip and row.end <= latest.end:
+                action = "removed"
+                self.deletes.append(row.stamp_id)
+            elif self.clip:
+                action = "clipped"
+                latest = self.updates[row.stamp_id] = row._replace(start=latest.end)
+            else:
+                action = None
+                if row.end > latest.end:
+                    latest = row
+            yield Overlap(first, row, action)
+
+    def apply(self):
+        "Write the collected changes, without committing"
+        if self.updates:
+            db.session.execute(
+                update(Stamps),
+                [
+                    {
+                        "id": interval.stamp_id,
+                        "start": interval.start,
+                        "end": interval.end,
+                        "duration_seconds": round((interval.end - interval.start).total_seconds()),
+                    }
+                    for interval in self.updates.values()
+                ],
+            )
+        for i in range(0, len(self.deletes), DELETE_BATCH):
+            db.session.execute(
+                delete(Stamps).where(Stamps.id.in_(self.deletes[i : i + DELETE_BATCH])),
+                execution_options={"synchronize_session": False},
+            )
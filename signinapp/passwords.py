@@ -0,0 +1,133 @@
+import functools
+import multiprocessing
+import os
+import re
+import threading
+from collections.abc import Callable, Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+
+from flask import Flask, Response, current_app, has_app_context
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .util import running_async
+
+# Hash methods with all of their cost parameters, so a stored hash's method can be compared
+METHOD_RE = re.compile(r"scrypt:\d+:\d+:\d+|pbkdf2:\w+:\d+")
+# Fewer passwords than this per process aren't worth starting the processes for
+MIN_PER_PROCESS = 8
+
+
+class Busy(Exception):
+    "More passwords are waiting to be hashed than PASSWORD_QUEUE allows"
+
+
+class PasswordPool:
+    """Hashes and checks passwords on a few threads of their own.
+
+    hashlib lets go of the GIL while it hashes, so the threads hash in
+    parallel, but never more at once than there are workers. Under gevent
+    they are real threads from gevent's pool, so a hash doesn't block every
+    other request of the worker. Once `queue` more are waiting, Busy is
+    raised, so a rush of logins is turned away rather than stalling scans.
+    """
+
+    def __init__(self, method: str, workers: int, queue: int):
+        self.method = method
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = queue
+        self.lock = threading.Lock()
+        # Started on first use in each worker process, after gunicorn forks and patches
+        self.pid = None
+        self.pool = None
+        self.slots = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if running_async():
+                from gevent.threadpool import ThreadPool
+
+                self.pool = ThreadPool(self.workers)
+            else:
+                self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="passwords")
+            self.slots = threading.BoundedSemaphore(self.workers + self.queue)
+            self.pid = os.getpid()
+
+    def run(self, func: Callable, *args):
+        if self.pid != os.getpid():
+            self.start()
+        if not self.slots.acquire(blocking=False):
+            raise Busy
+        try:
+            if isinstance(self.pool, ThreadPoolExecutor):
+                return self.pool.submit(func, *args).result()
+            return self.pool.apply(func, args)
+        finally:
+            self.slots.release()
+
+    def hash(self, password: str) -> str:
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash: str | None, password: str) -> bool:
+        return bool(pwhash) and self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        "Whether a hash was made with a different method or cost than the configured one"
+        return pwhash.partition("$")[0] != self.method
+
+
+def current_pool() -> PasswordPool | None:
+    return current_app.extensions.get("passwords") if has_app_context() else None
+
+
+def hash_password(password: str) -> str:
+    "Hash a password with PASSWORD_METHOD, on the password pool"
+    if pool := current_pool():
+        return pool.hash(password)
+    return generate_password_hash(password)
+
+
+def check_password(pwhash: str | None, password: str) -> bool:
+    "Whether a password matches a hash, which is never true for accounts without one"
+    if pool := current_pool():
+        return pool.check(pwhash, password)
+    return bool(pwhash) and check_password_hash(pwhash, password)
+
+
+def needs_rehash(pwhash: str) -> bool:
+    return bool(pool := current_pool()) and pool.needs_rehash(pwhash)
+
+
+def hash_passwords(passwords: Sequence[str]) -> list[str]:
+    """Hash many passwords at once, spread over a process for each CPU.
+
+    Each hash is deliberately slow, so an import of a few hundred users
+    would otherwise take minutes. The processes are spawned rather than
+    forked, since the app has threads running.
+    """
+    pool = current_pool()
+    hasher = functools.partial(generate_password_hash, method=pool.method if pool else "scrypt")
+    processes = min(os.cpu_count() or 1, len(passwords) // MIN_PER_PROCESS)
+    if processes <= 1:
+        return [hasher(password) for password in passwords]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        chunksize = max(1, len(passwords) // (processes * 4))
+        return list(executor.map(hasher, passwords, chunksize=chunksize))
+
+
+def busy(e: Busy):
+    return Response(
+        "Error: Too many passwords are being checked, try again in a moment",
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        {"Retry-After": "5"},
+    )
+
+
+def init_app(app: Flask):
+    app.extensions["passwords"] = PasswordPool(
+        app.config["PASSWORD_METHOD"], app.config["PASSWORD_WORKERS"], app.config["PASSWORD_QUEUE"]
+    )
+    app.register_error_handler(Busy, busy)
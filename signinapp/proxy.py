@@ -1,16 +1,67 @@
+import contextlib
+import hashlib
+import http.cookiejar
+import itertools
+import json
+import os
+import re
+import tempfile
+from http import HTTPStatus
+
 import requests
-from flask import Blueprint, Flask, Response, current_app, request
+from flask import Blueprint, Flask, Response, current_app, request, send_file
 from flask_login import current_user, login_required
+from requests.adapters import HTTPAdapter
 
 bp = Blueprint("kanboard", __name__, url_prefix="/kanboard")
 
+METHODS = ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+
+# Size of the blocks read from the client and the upstream server
+CHUNK_SIZE = 64 * 1024
+
+# Static assets that are safe to keep in the on-disk cache
+CACHEABLE_RE = re.compile(r"\.(js|css|png|jpe?g|gif|svg|ico|woff2?|ttf|eot)$", re.IGNORECASE)
+
+FORWARDED_HEADERS = [
+    "cookie",
+    "X-Requested-With",
+    "Content-Type",
+    "Accept",
+    "Range",
+]
+
+EXCLUDED_HEADERS = [
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+]
+
+
+class RequestBody:
+    "Wrap the client stream so requests sends it with a known Content-Length"
+
+    def __init__(self, stream, length: int):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+def get_session() -> requests.Session:
+    "Get the pooled session shared by every request in this worker"
+    return current_app.extensions["kanboard_proxy"]
+
 
 def calculate_headers(headers: dict):
     new_headers = dict()
-    for header_name in [
-        "cookie",
-        "X-Requested-With",
-    ]:
+    for header_name in FORWARDED_HEADERS:
         if header_name in headers:
             new_headers[header_name] = headers[header_name]
     new_headers.update(
@@ -23,46 +74,169 @@ def calculate_headers(headers: dict):
     return new_headers
 
 
-@bp.route("/<path:path>", methods=["GET", "POST"])
-@bp.route("/", methods=["GET", "POST"])
+def request_body():
+    "Stream the client body upstream instead of buffering it"
+    if request.content_length:
+        return RequestBody(request.stream, request.content_length)
+    if request.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        return iter(lambda: request.stream.read(CHUNK_SIZE), b"")
+    return None
+
+
+def response_headers(resp: requests.Response):
+    # Use the raw headers so repeated Set-Cookie headers are kept separate
+    return [
+        (name, value)
+        for (name, value) in resp.raw.headers.items()
+        if name.lower() not in EXCLUDED_HEADERS
+    ]
+
+
+def upstream(method: str, url: str, headers: dict, data=None) -> requests.Response:
+    return get_session().request(
+        method,
+        url,
+        params=list(request.args.items(multi=True)),
+        data=data,
+        headers=headers,
+        stream=True,
+        timeout=(
+            current_app.config["PROXY_CONNECT_TIMEOUT"],
+            current_app.config["PROXY_READ_TIMEOUT"],
+        ),
+    )
+
+
+def cache_path(url: str) -> str:
+    "Path of an asset's metadata in the cache, without the .json suffix"
+    key = hashlib.sha256(f"{url}?{request.query_string.decode()}".encode()).hexdigest()
+    return os.path.join(current_app.config["PROXY_CACHE_DIR"], key)
+
+
+def write_atomic(path: str, data: bytes):
+    "Write a file under a unique temporary name, then move it into place"
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def cached_asset(url: str, headers: dict) -> Response:
+    """Serve a static asset from the on-disk cache.
+
+    The upstream copy is revalidated with its ETag/Last-Modified on every request,
+    so the body is only transferred again when Kanboard actually changes it.
+    Bodies are stored under their digest and the metadata names the digest, so
+    replacing the metadata file switches to a new body in one step.
+    """
+    path = cache_path(url)
+    headers.pop("Range", None)
+    meta = None
+    if os.path.exists(f"{path}.json"):
+        with open(f"{path}.json") as f:
+            meta = json.load(f)
+        if not os.path.exists(f"{path}-{meta['etag']}"):
+            meta = None
+    if meta:
+        if meta.get("upstream_etag"):
+            headers["If-None-Match"] = meta["upstream_etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    resp = upstream("GET", url, headers)
+    if meta and resp.status_code == HTTPStatus.NOT_MODIFIED:
+        resp.close()
+        return send_file(
+            f"{path}-{meta['etag']}",
+            mimetype=meta["content_type"],
+            etag=meta["etag"],
+            conditional=True,
+        )
+
+    # Only bodies that turn out to fit, whatever Content-Length claimed, are cached
+    max_size = current_app.config["PROXY_CACHE_MAX_SIZE"]
+    body = resp.iter_content(CHUNK_SIZE)
+    chunks = []
+    if resp.status_code == HTTPStatus.OK and int(resp.headers.get("Content-Length", 0)) <= max_size:
+        size = 0
+        for chunk in body:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_size:
+                break
+        else:
+            resp.close()
+            return store_asset(path, meta, resp, b"".join(chunks))
+
+    # Errors and oversized assets are passed through untouched
+    response = Response(itertools.chain(chunks, body), resp.status_code, response_headers(resp))
+    response.call_on_close(resp.close)
+    return response
+
+
+def store_asset(path: str, old_meta: dict | None, resp: requests.Response, data: bytes) -> Response:
+    meta = {
+        "etag": hashlib.sha256(data).hexdigest(),
+        "upstream_etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "content_type": resp.headers.get("Content-Type"),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(f"{path}-{meta['etag']}", data)
+    write_atomic(f"{path}.json", json.dumps(meta).encode())
+    if old_meta and old_meta["etag"] != meta["etag"]:
+        # The old body is only sent after upstream confirms it's unchanged, which it no longer is
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f"{path}-{old_meta['etag']}")
+    return send_file(
+        f"{path}-{meta['etag']}", mimetype=meta["content_type"], etag=meta["etag"], conditional=True
+    )
+
+
+@bp.route("/<path:path>", methods=METHODS)
+@bp.route("/", methods=METHODS)
 @login_required
 def index(path=""):
+    """Forward a request to Kanboard.
+
+    Under the gevent workers (see gunicorn.conf.py) the upstream socket I/O is
+    cooperative, so a slow Kanboard response doesn't hold a worker slot.
+    """
     url = current_app.config.get("PROXY_URL") + path
     headers = calculate_headers(request.headers)
 
-    if request.method == "GET":
-        resp = requests.get(url, params=dict(request.args), headers=headers)
-    elif request.method == "POST":
-        # If the content type isn't form-data then copy from data
-        # Need to use find here since the content type looks like:
-        # 'multipart/form-data; boundary=---------------------------5113784293436132453515092771'
-        if not request.content_type.startswith(
-            "multipart/form-data"
-        ) and not request.content_type.startswith("application/x-www-form-urlencoded"):
-            data = request.data
-            headers["Content-Type"] = request.content_type
-        else:
-            data = request.form
-        resp = requests.post(
-            url,
-            data=data,
-            params=dict(request.args),
-            headers=headers,
-        )
-    excluded_headers = [
-        "content-encoding",
-        "content-length",
-        "transfer-encoding",
-        "connection",
-    ]
-    headers = [
-        (name, value)
-        for (name, value) in resp.raw.headers.items()
-        if name.lower() not in excluded_headers
-    ]
-    response = Response(resp.content, resp.status_code, headers)
+    try:
+        if (
+            request.method == "GET"
+            and CACHEABLE_RE.search(path)
+            and current_app.config["PROXY_CACHE_DIR"]
+        ):
+            return cached_asset(url, headers)
+        resp = upstream(request.method, url, headers, data=request_body())
+    except requests.RequestException as e:
+        return Response(f"Error: Could not reach Kanboard: {e}", HTTPStatus.BAD_GATEWAY)
+
+    response = Response(resp.iter_content(CHUNK_SIZE), resp.status_code, response_headers(resp))
+    # Hand the connection back to the pool once the body has been sent
+    response.call_on_close(resp.close)
     return response
 
 
 def init_app(app: Flask):
+    app.config.setdefault("PROXY_CACHE_DIR", os.path.join(app.instance_path, "kanboard-cache"))
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=app.config["PROXY_POOL_SIZE"],
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Connections are shared by every user, cookies must not be: each request only carries
+    # the client's own Cookie header, and Set-Cookie is only passed back to the client
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    app.extensions["kanboard_proxy"] = session
     app.register_blueprint(bp)
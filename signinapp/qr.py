@@ -1,28 +1,180 @@
-from flask import Blueprint, Flask, request, url_for
+import functools
+import hashlib
+import io
+from http import HTTPStatus
+
+import segno
+from flask import Blueprint, Flask, Response, abort, request, url_for
 from flask.templating import render_template
+from flask_login import current_user, login_required
+from markupsafe import escape
+from sqlalchemy.future import select
+
+from .model import Event, User, db
+from .util import mentor_required
 
 qr = Blueprint("qr", __name__)
 
+FORMATS = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+}
+
+REGISTER_ENDPOINTS = {
+    "student": "auth.register",
+    "mentor": "auth.register_mentor",
+    "guardian": "auth.register_guardian",
+}
+
+# Pixels per QR module
+SCALE = 8
+
+# One year, the longest lifetime browsers honor
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Layout of the printable badge sheet, in pixels
+SHEET_COLUMNS = 4
+SHEET_CELL_WIDTH = 200
+SHEET_CELL_HEIGHT = 230
+SHEET_LABEL_SIZE = 14
+
+
+def qr_version(data: str) -> str:
+    "Content hash used as the cache-busting version and ETag of a QR code"
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def make_qr(data: str) -> segno.QRCode:
+    return segno.make(data, error="m", micro=False)
+
+
+@functools.lru_cache(maxsize=512)
+def render_qr(data: str, fmt: str) -> bytes:
+    "Render a QR code, caching the result by content"
+    buffer = io.BytesIO()
+    make_qr(data).save(buffer, kind=fmt, scale=SCALE, dark="black", light="white")
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=1024)
+def render_inline_svg(data: str, size: int) -> str:
+    "Render a QR code as an <svg> element sized to fit a size x size box"
+    code = make_qr(data)
+    scale = size / code.symbol_size(scale=1)[0]
+    return code.svg_inline(scale=scale, dark="black", light="white")
+
+
+def qr_response(data: str, fmt: str, private: bool) -> Response:
+    if fmt not in FORMATS:
+        abort(HTTPStatus.NOT_FOUND)
+
+    etag = f"{qr_version(data)}-{fmt}"
+    response = Response(mimetype=FORMATS[fmt])
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response.status_code = HTTPStatus.NOT_MODIFIED
+    else:
+        response.set_data(render_qr(data, fmt))
+
+    response.cache_control.private = private
+    response.cache_control.public = not private
+    if request.args.get("v") == qr_version(data):
+        # Versioned URLs change whenever the content does
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def register_url(kind: str) -> str:
+    return f"{request.host_url.rstrip('/')}{url_for(REGISTER_ENDPOINTS[kind])}"
+
+
+def event_url(event_code: str) -> str:
+    return f"{request.host_url.rstrip('/')}{url_for('event.selfevent', event_code=event_code)}"
+
 
 @qr.route("/register/qr")
 def register_qr():
-    url = request.host_url
-    return render_template("qr.html.jinja2", register_url=f"{url}{url_for('auth.register')}")
+    return render_template("qr.html.jinja2", register_url=register_url("student"), kind="student")
 
 
 @qr.route("/register/mentor/qr")
 def register_mentor_qr():
-    url = request.host_url
-    return render_template("qr.html.jinja2", register_url=f"{url}{url_for('auth.register_mentor')}")
+    return render_template("qr.html.jinja2", register_url=register_url("mentor"), kind="mentor")
 
 
 @qr.route("/register/guardian/qr")
 def register_guardian_qr():
-    url = request.host_url
-    return render_template(
-        "qr.html.jinja2", register_url=f"{url}{url_for('auth.register_guardian')}"
-    )
+    return render_template("qr.html.jinja2", register_url=register_url("guardian"), kind="guardian")
+
+
+@qr.route("/qr/register/<kind>.<fmt>")
+def register_image(kind: str, fmt: str):
+    if kind not in REGISTER_ENDPOINTS:
+        abort(HTTPStatus.NOT_FOUND)
+    return qr_response(register_url(kind), fmt, private=False)
+
+
+@qr.route("/qr/user/<int:user_id>.<fmt>")
+@login_required
+def user_image(user_id: int, fmt: str):
+    user = db.session.get(User, user_id)
+    if not user or not current_user.can_view(user):
+        abort(HTTPStatus.NOT_FOUND)
+    return qr_response(user.code, fmt, private=True)
+
+
+@qr.route("/qr/event/<event_code>.<fmt>")
+@login_required
+def event_image(event_code: str, fmt: str):
+    if not current_user.role.can_display or not Event.get_from_code(event_code):
+        abort(HTTPStatus.NOT_FOUND)
+    return qr_response(event_url(event_code), fmt, private=True)
+
+
+@qr.route("/qr/badges.svg")
+@mentor_required
+def badge_sheet():
+    "A single printable page with the QR code of every approved user"
+    users = db.session.execute(
+        select(User.name, User.preferred_name, User.code)
+        .where(User.approved == True)  # noqa: E712
+        .where(User.role.has(visible=True))
+        .order_by(User.name)
+    ).all()
+
+    qr_size = SHEET_CELL_WIDTH - 20
+    rows = (len(users) + SHEET_COLUMNS - 1) // SHEET_COLUMNS
+    width = SHEET_COLUMNS * SHEET_CELL_WIDTH
+    height = max(rows, 1) * SHEET_CELL_HEIGHT
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}" font-family="sans-serif" '
+        f'font-size="{SHEET_LABEL_SIZE}" text-anchor="middle">',
+        f'<rect width="{width}" height="{height}" fill="white"/>',
+    ]
+    for i, (name, preferred_name, code) in enumerate(users):
+        x = (i % SHEET_COLUMNS) * SHEET_CELL_WIDTH
+        y = (i // SHEET_COLUMNS) * SHEET_CELL_HEIGHT
+        label = escape(preferred_name or name)
+        parts.append(
+            f'<g transform="translate({x + 10},{y + 10})">'
+            f"{render_inline_svg(code, qr_size)}"
+            f'<text x="{qr_size / 2}" y="{qr_size + SHEET_LABEL_SIZE + 4}">{label}</text>'
+            "</g>"
+        )
+    parts.append("</svg>")
+
+    response = Response("".join(parts), mimetype=FORMATS["svg"])
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 def init_app(app: Flask):
+    app.add_template_global(qr_version)
     app.register_blueprint(qr)
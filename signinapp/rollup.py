@@ -0,0 +1,53 @@
+import enum
+from collections.abc import Sequence
+
+from sqlalchemy import func
+from sqlalchemy.future import select
+
+from .model import Role, Student, Subteam, User, db
+
+# Columns users can be counted by, with their display names
+DIMENSIONS = {
+    "shirt": ("Shirt size", User.tshirt_size),
+    "role": ("Role", Role.name),
+    "subteam": ("Subteam", Subteam.name),
+    "pronouns": ("Pronouns", User.pronouns),
+    "graduation_year": ("Graduation year", Student.graduation_year),
+}
+
+
+def sort_key(row: tuple) -> tuple:
+    "Enums in their declared order rather than by name, with unset values last"
+    return tuple(
+        (value is None, list(type(value)).index(value) if isinstance(value, enum.Enum) else value)
+        for value in row[:-1]
+    )
+
+
+def rollup(dimensions: Sequence[str]) -> list[tuple]:
+    """Number of visible users for each combination of `dimensions`, in a single GROUP BY.
+
+    Each row holds one value per dimension, None where it isn't set,
+    followed by the count.
+    """
+    columns = [DIMENSIONS[dimension][1] for dimension in dimensions]
+    stmt = (
+        select(*columns, func.count(User.id))
+        .select_from(User)
+        .join(Role, User.role_id == Role.id)
+        .where(Role.visible == True)  # noqa: E712
+        .group_by(*columns)
+    )
+    if "subteam" in dimensions:
+        stmt = stmt.outerjoin(Subteam, User.subteam_id == Subteam.id)
+    if "graduation_year" in dimensions:
+        stmt = stmt.outerjoin(Student, Student.user_id == User.id)
+    return sorted((tuple(row) for row in db.session.execute(stmt)), key=sort_key)
+
+
+def label(value) -> str:
+    if value is None:
+        return "Not set"
+    if isinstance(value, enum.Enum):
+        return value.value
+    return str(value)
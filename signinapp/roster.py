@@ -0,0 +1,398 @@
+import csv
+import dataclasses
+import enum
+import importlib.util
+import io
+import re
+from collections import Counter
+from collections.abc import Iterable, Iterator, Sequence
+from typing import IO
+
+from flask import current_app
+from sqlalchemy import func, insert
+from sqlalchemy.future import select
+from sqlalchemy.orm import joinedload, selectinload
+
+from .model import (
+    Guardian,
+    Pronoun,
+    Role,
+    RuleKind,
+    ShirtSizes,
+    Student,
+    Subteam,
+    User,
+    db,
+    parent_child_association_table,
+)
+from .passwords import hash_passwords
+from .util import get_current_graduation_years, normalize_phone_number_for_storage
+
+# Columns of each student that can be exported, with their headers
+STUDENT_FIELDS = {
+    "name": ("Student Name", lambda student: student.user.full_name),
+    "email": ("Email", lambda student: student.user.email),
+    "phone": ("Phone Number", lambda student: student.user.formatted_phone_number),
+    "address": ("Address", lambda student: student.user.address),
+    "graduation_year": ("Graduation Year", lambda student: student.graduation_year),
+    "subteam": ("Subteam", lambda student: student.user.subteam and student.user.subteam.name),
+    "shirt": (
+        "Shirt Size",
+        lambda student: student.user.tshirt_size and student.user.tshirt_size.value,
+    ),
+}
+# Columns repeated for each of a student's guardians
+GUARDIAN_FIELDS = {
+    "name": ("Name", lambda guardian: guardian.user.name),
+    "email": ("Email", lambda guardian: guardian.user.email),
+    "phone": ("Phone Number", lambda guardian: guardian.user.formatted_phone_number),
+}
+ORDINALS = ["First", "Second", "Third", "Fourth"]
+# Students loaded from the database at a time
+BATCH_SIZE = 500
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Columns of an imported roster, along with guardian_<n>_name, guardian_<n>_email and _phone
+IMPORT_COLUMNS = [
+    "role",
+    "name",
+    "email",
+    "password",
+    "preferred_name",
+    "phone",
+    "address",
+    "subteam",
+    "shirt",
+    "pronouns",
+    "graduation_year",
+]
+GUARDIAN_COLUMN = re.compile(r"guardian_(\d+)_(name|email|phone)")
+
+
+def xlsx_available() -> bool:
+    return importlib.util.find_spec("openpyxl") is not None
+
+
+def guardian_header(index: int, field: str) -> str:
+    parent = f"{ORDINALS[index]} Parent" if index < len(ORDINALS) else f"Parent {index + 1}"
+    return f"{parent} {GUARDIAN_FIELDS[field][0]}"
+
+
+def most_guardians(*criteria) -> int:
+    "Most guardians of any student matching `criteria`"
+    counts = (
+        select(func.count().label("guardians"))
+        .select_from(parent_child_association_table)
+        .join(Student, Student.id == parent_child_association_table.c.user_id)
+        .where(*criteria)
+        .group_by(Student.id)
+        .subquery()
+    )
+    return db.session.scalar(select(func.max(counts.c.guardians))) or 0
+
+
+def roster(
+    fields: Sequence[str],
+    guardian_fields: Sequence[str],
+    guardians: int | None = None,
+    include_all=False,
+) -> Iterator[list]:
+    """A header, then a row for each current student, streamed from one query.
+
+    Users, subteams and guardians are loaded along with each batch of
+    students, so no row needs a query of its own. Guardians are in contact
+    order, with columns for as many as any student has unless `guardians`
+    is given.
+    """
+    criteria = [] if include_all else [Student.graduation_year.in_(get_current_graduation_years())]
+    if guardians is None:
+        guardians = most_guardians(*criteria)
+
+    yield [STUDENT_FIELDS[field][0] for field in fields] + [
+        guardian_header(i, field) for i in range(guardians) for field in guardian_fields
+    ]
+    stmt = (
+        select(Student)
+        .where(*criteria)
+        .options(
+            joinedload(Student.user).joinedload(User.subteam),
+            selectinload(Student.guardians).joinedload(Guardian.user),
+        )
+        .order_by(Student.user_id)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+    for student in db.session.scalars(stmt):
+        row = [STUDENT_FIELDS[field][1](student) for field in fields]
+        ordered = sorted(student.guardians, key=lambda guardian: guardian.contact_order)
+        for i in range(guardians):
+            row += [
+                GUARDIAN_FIELDS[field][1](ordered[i]) if i < len(ordered) else ""
+                for field in guardian_fields
+            ]
+        yield row
+
+
+def csv_lines(rows: Iterable[list]) -> Iterator[str]:
+    "Each row as a line of CSV, as it is produced"
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def write_xlsx(rows: Iterable[list], file: IO[bytes]):
+    """Write rows to an XLSX workbook, which needs openpyxl.
+
+    The workbook is write-only, so rows are spooled to disk rather than kept
+    in memory, but the file can only be sent once it's complete.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Students")
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+
+@dataclasses.dataclass
+class ImportResult:
+    # Users created for each role
+    created: Counter[str] = dataclasses.field(default_factory=Counter)
+    # Guardians linked to students
+    links: int = 0
+    # Emails that already have an account, which are left as they are
+    skipped: list[str] = dataclasses.field(default_factory=list)
+    errors: list[str] = dataclasses.field(default_factory=list)
+
+    def summary(self) -> str:
+        users = ", ".join(f"{count} {role}" for role, count in sorted(self.created.items()))
+        return f"{users or 'no'} users and {self.links} guardian links"
+
+
+def column_key(header: str) -> str:
+    return header.strip().lower().replace(" ", "_")
+
+
+def enum_member(enum_type: type[enum.Enum], value: str) -> enum.Enum:
+    "An enum member by its name or value, ignoring case"
+    for member in enum_type:
+        if value.lower() in (member.name.lower(), member.value.lower()):
+            return member
+    raise ValueError(value)
+
+
+def import_roster(file: IO[str], dry_run=False) -> ImportResult:
+    """Create the users listed in a CSV roster, without committing.
+
+    Each row is a user with the IMPORT_COLUMNS, and students can list their
+    guardians, who get guardian_limited accounts if they don't have one
+    yet. Existing users are looked up in one query, and users, students,
+    guardians and their links are each written with a single bulk INSERT,
+    once every row is valid. Nothing is written if any row has an error,
+    or with `dry_run`, which only counts who would be created.
+    """
+    result = ImportResult()
+    rows = [
+        {column_key(key): (value or "").strip() for key, value in row.items() if key}
+        for row in csv.DictReader(file)
+    ]
+    roles = {role.name.lower(): role for role in db.session.scalars(select(Role))}
+    subteams = {
+        name.lower(): subteam_id
+        for subteam_id, name in db.session.execute(select(Subteam.id, Subteam.name))
+    }
+
+    emails = {
+        value.lower()
+        for row in rows
+        for key, value in row.items()
+        if value and (key == "email" or key.endswith("_email"))
+    }
+    # Email of each existing user, with their id and guardian data id
+    existing = {
+        email.lower(): (user_id, guardian_id)
+        for user_id, email, guardian_id in db.session.execute(
+            select(User.id, User.email, Guardian.id)
+            .outerjoin(Guardian, Guardian.user_id == User.id)
+            .where(func.lower(User.email).in_(emails))
+        )
+    }
+
+    users: dict[str, dict] = {}
+    passwords: dict[str, str] = {}
+    graduation_years: dict[str, int] = {}
+    # Emails of guardians, with their contact order
+    guardians: dict[str, int] = {}
+    links: set[tuple[str, str]] = set()
+    implied: dict[str, dict] = {}
+    for line, row in enumerate(rows, start=2):
+        email = row.get("email", "").lower()
+        if not email or not row.get("name"):
+            result.errors.append(f"Row {line}: a name and email are required")
+            continue
+        if email in users:
+            result.errors.append(f"Row {line}: {email} is listed twice")
+            continue
+        if email in existing:
+            result.skipped.append(email)
+            continue
+        errors = []
+
+        role = roles.get((row.get("role") or "student").lower())
+        if not role:
+            errors.append(f"unknown role {row['role']}")
+        elif not role.guardian and not row.get("password"):
+            errors.append("a password is required")
+        subteam_id = None
+        if row.get("subteam") and (subteam_id := subteams.get(row["subteam"].lower())) is None:
+            errors.append(f"unknown subteam {row['subteam']}")
+        values = {}
+        for key, enum_type in (("shirt", ShirtSizes), ("pronouns", Pronoun)):
+            if row.get(key):
+                try:
+                    values[key] = enum_member(enum_type, row[key])
+                except ValueError:
+                    errors.append(f"unknown {key} {row[key]}")
+        # Like Student.make, students always have student data and nobody else does
+        student = role is not None and role.name == "student"
+        if student and not row.get("graduation_year"):
+            errors.append("students need a graduation year")
+        elif role and not student and row.get("graduation_year"):
+            errors.append(f"only students have a graduation year, not {role.name}")
+        elif row.get("graduation_year"):
+            if row["graduation_year"].isdigit():
+                graduation_years[email] = int(row["graduation_year"])
+            else:
+                errors.append(f"invalid graduation year {row['graduation_year']}")
+
+        for key, value in sorted(row.items()):
+            if not value or not (match := GUARDIAN_COLUMN.fullmatch(key)):
+                continue
+            number, field = match.groups()
+            if not student:
+                errors.append("only students can list guardians")
+                break
+            if field != "email":
+                continue
+            guardian_email = value.lower()
+            guardians.setdefault(guardian_email, int(number))
+            links.add((guardian_email, email))
+            if guardian_email not in existing:
+                if "guardian_limited" not in roles:
+                    errors.append("unknown role guardian_limited for new guardians")
+                    break
+                # Unapproved, like the guardians made when a student registers
+                implied.setdefault(
+                    guardian_email,
+                    {
+                        "email": value,
+                        "name": row.get(f"guardian_{number}_name") or value,
+                        "phone_number": normalize_phone_number_for_storage(
+                            row.get(f"guardian_{number}_phone")
+                        )
+                        or None,
+                        "preferred_name": None,
+                        "address": None,
+                        "subteam_id": None,
+                        "tshirt_size": None,
+                        "pronouns": None,
+                        "role_id": roles["guardian_limited"].id,
+                        "approved": False,
+                        "password": None,
+                    },
+                )
+
+        if errors:
+            result.errors.append(f"Row {line}: {', '.join(errors)}")
+            continue
+        if role.guardian:
+            guardians.setdefault(email, 0)
+        if row.get("password"):
+            passwords[email] = row["password"]
+        users[email] = {
+            "email": row["email"],
+            "name": row["name"],
+            "preferred_name": row.get("preferred_name") or None,
+            "phone_number": normalize_phone_number_for_storage(row.get("phone")) or None,
+            "address": row.get("address") or None,
+            "subteam_id": subteam_id,
+            "tshirt_size": values.get("shirt"),
+            "pronouns": values.get("pronouns"),
+            "role_id": role.id,
+            "approved": True,
+            "password": None,
+        }
+
+    # Guardians listed by students and on rows of their own get the row's details
+    users |= {email: user for email, user in implied.items() if email not in users}
+    role_names = {role.id: role.name for role in roles.values()}
+    result.created.update(role_names[user["role_id"]] for user in users.values())
+    result.links = len(links)
+    if result.errors or dry_run or not users:
+        return result
+
+    for email, password in zip(passwords, hash_passwords(list(passwords.values())), strict=True):
+        users[email]["password"] = password
+    # Each table is filled by one executemany, and the new ids read back by email.
+    # Without render_nulls, rows are split into a statement per pattern of NULLs
+    db.session.execute(insert(User).execution_options(render_nulls=True), list(users.values()))
+    user_ids = {
+        email.lower(): user_id
+        for user_id, email in db.session.execute(
+            select(User.id, User.email).where(func.lower(User.email).in_(users))
+        )
+    }
+
+    if graduation_years:
+        db.session.execute(
+            insert(Student),
+            [
+                {"user_id": user_ids[email], "graduation_year": year}
+                for email, year in graduation_years.items()
+            ],
+        )
+    student_ids = dict(
+        db.session.execute(
+            select(Student.user_id, Student.id).where(
+                Student.user_id.in_(user_ids[email] for email in graduation_years)
+            )
+        ).all()
+    )
+
+    guardian_users = {
+        email: user_ids[email] if email in user_ids else existing[email][0] for email in guardians
+    }
+    new_guardians = [
+        {"user_id": guardian_users[email], "contact_order": order}
+        for email, order in guardians.items()
+        if email not in existing or existing[email][1] is None
+    ]
+    if new_guardians:
+        db.session.execute(insert(Guardian), new_guardians)
+    guardian_ids = dict(
+        db.session.execute(
+            select(Guardian.user_id, Guardian.id).where(
+                Guardian.user_id.in_(guardian_users.values())
+            )
+        ).all()
+    )
+
+    if links:
+        db.session.execute(
+            insert(parent_child_association_table),
+            [
+                {
+                    "guardians": guardian_ids[guardian_users[guardian]],
+                    "user_id": student_ids[user_ids[student]],
+                }
+                for guardian, student in links
+            ],
+        )
+
+    # Bulk inserts skip the session hooks that check badge rules
+    if rules := current_app.extensions.get("badge_rules"):
+        rules.award({user_id: {RuleKind.Subteam} for user_id in user_ids.values()})
+    return result
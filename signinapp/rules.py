@@ -0,0 +1,181 @@
+import threading
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+from datetime import date
+from typing import NamedTuple
+
+from flask import Flask, current_app, has_app_context
+from sqlalchemy import event, exists, func, insert, literal
+from sqlalchemy.future import select
+
+from .changes import changed_tables, subscribe
+from .database import RoutingSession
+from .model import (
+    BadgeAward,
+    BadgeRule,
+    Event,
+    RuleKind,
+    Stamps,
+    User,
+    db,
+    school_year_for_date,
+)
+
+# Session.info key of the users written in the current transaction, with the rule kinds to check
+AFFECTED = "badge_rule_users"
+# Most rounds of badges earned by holding badges that were just awarded
+MAX_ROUNDS = 10
+
+
+class Rule(NamedTuple):
+    "The columns of a BadgeRule, which outlive the session it was loaded in"
+
+    kind: RuleKind
+    threshold: int
+    event_type_id: int | None
+    current_year: bool
+    subteam_id: int | None
+    required_badge_id: int | None
+
+
+def condition(rule: Rule, year: int):
+    "Whether the user in the enclosing query meets `rule`, in SQL"
+    if rule.kind == RuleKind.Subteam:
+        return User.subteam_id == rule.subteam_id
+    if rule.kind == RuleKind.Badge:
+        return exists().where(
+            BadgeAward.user_id == User.id, BadgeAward.badge_id == rule.required_badge_id
+        )
+
+    criteria = [Stamps.user_id == User.id]
+    if rule.event_type_id:
+        criteria.append(Event.type_id == rule.event_type_id)
+    if rule.current_year:
+        criteria.append(Event.school_year == year)
+    if rule.kind == RuleKind.Hours:
+        total, needed = func.coalesce(func.sum(Stamps.duration_seconds), 0), rule.threshold * 3600
+    else:
+        total, needed = func.count(func.distinct(Stamps.event_id)), rule.threshold
+    return (
+        select(total).join(Event, Stamps.event_id == Event.id).where(*criteria).scalar_subquery()
+        >= needed
+    )
+
+
+class RuleSet:
+    """Awards badges to the users that meet all of the badge's rules.
+
+    Each badge is checked with one INSERT ... SELECT, so awards are written
+    in a batch. Badges are never taken away by the rules.
+    """
+
+    def __init__(self):
+        self.rules: dict[int, list[Rule]] | None = None
+        # Bumped by every invalidation, so rules loaded during one aren't kept
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self) -> dict[int, list[Rule]]:
+        "Rules by badge id"
+        if (rules := self.rules) is not None:
+            return rules
+        generation = self.generation
+        rules = defaultdict(list)
+        for badge_id, *columns in db.session.execute(
+            select(
+                BadgeRule.badge_id,
+                BadgeRule.kind,
+                BadgeRule.threshold,
+                BadgeRule.event_type_id,
+                BadgeRule.current_year,
+                BadgeRule.subteam_id,
+                BadgeRule.required_badge_id,
+            )
+        ):
+            rules[badge_id].append(Rule(*columns))
+        with self.lock:
+            if generation == self.generation:
+                self.rules = rules
+        return rules
+
+    def invalidate(self, tables: set[str]):
+        if "badge_rules" in tables:
+            with self.lock:
+                self.generation += 1
+                self.rules = None
+
+    def award(
+        self,
+        users: Mapping[int, set[RuleKind]] | None = None,
+        badge_ids: set[int] | None = None,
+    ) -> Counter[int]:
+        """Award the badges users have earned, without committing.
+
+        With `users`, only those users are checked, and only for badges with
+        a rule of the kinds given for each of them. Otherwise every user is.
+        Returns the number of users awarded each badge.
+        """
+        year = school_year_for_date(date.today())
+        awarded = Counter()
+        for _ in range(MAX_ROUNDS):
+            earned = defaultdict(set)
+            for badge_id, rules in self.get().items():
+                if badge_ids is not None and badge_id not in badge_ids:
+                    continue
+                stmt = select(User.id, literal(badge_id)).where(
+                    *(condition(rule, year) for rule in rules),
+                    ~exists().where(BadgeAward.user_id == User.id, BadgeAward.badge_id == badge_id),
+                )
+                if users is not None:
+                    kinds = {rule.kind for rule in rules}
+                    candidates = [user_id for user_id, changed in users.items() if changed & kinds]
+                    if not candidates:
+                        continue
+                    stmt = stmt.where(User.id.in_(candidates))
+                for user_id in db.session.scalars(
+                    insert(BadgeAward)
+                    .from_select(["user_id", "badge_id"], stmt)
+                    .returning(BadgeAward.user_id)
+                ):
+                    earned[user_id].add(RuleKind.Badge)
+                    awarded[badge_id] += 1
+            if not earned:
+                break
+            # Only badges that need one of the new badges can be earned next
+            users, badge_ids = earned, None
+        return awarded
+
+
+def record_affected(session, flush_context):
+    affected = session.info.setdefault(AFFECTED, defaultdict(set))
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Stamps):
+            affected[obj.user_id] |= {RuleKind.Hours, RuleKind.Events}
+        elif isinstance(obj, BadgeAward):
+            affected[obj.user_id].add(RuleKind.Badge)
+        elif isinstance(obj, User) and session.is_modified(obj):
+            affected[obj.id].add(RuleKind.Subteam)
+
+
+def award_affected(session):
+    "Check the rules for the users written in this transaction, before it commits"
+    if not has_app_context() or not (rules := current_app.extensions.get("badge_rules")):
+        return
+    # Commit flushes after this, too late for the rules to see the new rows
+    session.flush()
+    if affected := session.info.pop(AFFECTED, None):
+        rules.award(affected)
+
+
+def forget_affected(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(AFFECTED, None)
+
+
+def init_app(app: Flask):
+    rules = app.extensions["badge_rules"] = RuleSet()
+    subscribe(app, lambda changes: rules.invalidate(changed_tables(changes)))
+    if not event.contains(RoutingSession, "before_commit", award_affected):
+        event.listen(RoutingSession, "after_flush", record_affected)
+        event.listen(RoutingSession, "before_commit", award_affected)
+        event.listen(RoutingSession, "after_transaction_end", forget_affected)
@@ -1,40 +1,152 @@
-from flask import Blueprint, Flask
+from datetime import date, datetime, time, timedelta
+
+import flask_excel as excel
+from flask import Blueprint, Flask, jsonify, request
 from flask.templating import render_template
 from flask_wtf import FlaskForm
-from wtforms import SelectField, SubmitField
+from sqlalchemy import func
+from sqlalchemy.future import select
+from wtforms import DateField, IntegerField, SelectField, SubmitField
+from wtforms.validators import NumberRange, Optional
 
-from .model import EventType, Role, User, db, get_form_ids
-from .util import MultiCheckboxField, mentor_required
+from .database import read_replica
+from .model import (
+    Event,
+    EventType,
+    Role,
+    Stamps,
+    Subteam,
+    User,
+    db,
+    get_form_ids,
+    school_year_for_date,
+)
+from .util import MultiCheckboxField, correct_time_for_storage, mentor_required
 
 search = Blueprint("search", __name__)
 
+FORMATS = [("html", "Table"), ("csv", "CSV"), ("json", "JSON")]
+
 
 class HoursForm(FlaskForm):
     role = MultiCheckboxField()
-    category = SelectField(choices=lambda: get_form_ids(EventType))
+    category = SelectField(
+        "Event type", choices=lambda: [(0, "All")] + get_form_ids(EventType), coerce=int, default=0
+    )
+    subteam = SelectField(
+        choices=lambda: [(0, "All")] + get_form_ids(Subteam), coerce=int, default=0
+    )
+    year = IntegerField(
+        "School year",
+        default=lambda: school_year_for_date(date.today()),
+        validators=[Optional()],
+    )
+    start = DateField(validators=[Optional()])
+    end = DateField(validators=[Optional()])
+    top = IntegerField("Top N", validators=[Optional(), NumberRange(min=1)])
+    format = SelectField(choices=FORMATS, default="html")
     submit = SubmitField()
 
 
+def hours_totals(
+    roles: list[str],
+    event_type_id: int | None = None,
+    subteam_id: int | None = None,
+    year: int | None = None,
+    start: date | None = None,
+    end: date | None = None,
+    top: int | None = None,
+) -> list[tuple[User, timedelta]]:
+    """Total hours per approved user, in a single grouped query.
+
+    With `top`, only the users with the most hours are returned, most first.
+    Otherwise users are sorted by name.
+    """
+    total = func.sum(Stamps.elapsed_seconds).label("total")
+    stmt = (
+        select(User, total)
+        .join(Stamps, Stamps.user_id == User.id)
+        .join(Event, Stamps.event_id == Event.id)
+        .join(Role, User.role_id == Role.id)
+        .where(User.approved == True)  # noqa: E712
+        .where(Role.visible == True)  # noqa: E712
+        .where(Role.name.in_(roles))
+        .group_by(User.id)
+        .having(total > 0)
+    )
+    if event_type_id:
+        stmt = stmt.where(Event.type_id == event_type_id)
+    if subteam_id:
+        stmt = stmt.where(User.subteam_id == subteam_id)
+    if year:
+        stmt = stmt.where(Event.school_year == year)
+    if start:
+        stmt = stmt.where(Stamps.start >= correct_time_for_storage(datetime.combine(start, time())))
+    if end:
+        stmt = stmt.where(
+            Stamps.start
+            < correct_time_for_storage(datetime.combine(end + timedelta(days=1), time()))
+        )
+    if top:
+        stmt = stmt.order_by(total.desc(), User.name).limit(top)
+    else:
+        stmt = stmt.order_by(User.name)
+
+    return [(user, timedelta(seconds=round(seconds))) for user, seconds in db.session.execute(stmt)]
+
+
 @search.route("/search/hours", methods=["GET", "POST"])
 @mentor_required
+@read_replica
 def hours():
-    form = HoursForm()
+    """Search hours by role and event type.
+
+    The filters can also be given as query parameters (e.g. ?role=student&format=json)
+    for scripts that want the totals as CSV or JSON.
+    """
+    from_args = request.method == "GET" and bool(request.args)
+    form = HoursForm(formdata=request.args, meta={"csrf": False}) if from_args else HoursForm()
     form.role.choices = [r.name for r in Role.get_visible()]
 
-    if form.validate_on_submit():
-        users = User.get_visible_users()
-        event_type = db.session.get(EventType, form.category.data)
-        roles = [Role.from_name(r).id for r in form.role.data]
-        results = sorted(
+    if not (form.validate() if from_args else form.validate_on_submit()):
+        return render_template("search/hours.html.jinja2", form=form, results=None)
+
+    results = hours_totals(
+        form.role.data,
+        event_type_id=form.category.data,
+        subteam_id=form.subteam.data,
+        year=form.year.data,
+        start=form.start.data,
+        end=form.end.data,
+        top=form.top.data,
+    )
+
+    if form.format.data == "json":
+        return jsonify(
             [
-                (u.display_name, u.total_stamps_for(event_type))
-                for u in users
-                if u.role_id in roles and u.total_time and u.approved
+                {
+                    "name": user.display_name,
+                    "email": user.email,
+                    "hours": total.total_seconds() / 3600,
+                }
+                for user, total in results
             ]
         )
-        return render_template("search/hours.html.jinja2", form=form, results=results)
-
-    return render_template("search/hours.html.jinja2", form=form, results=None)
+    if form.format.data == "csv":
+        return excel.make_response_from_array(
+            [["Name", "Email", "Hours"]]
+            + [
+                [user.display_name, user.email, round(total.total_seconds() / 3600, 2)]
+                for user, total in results
+            ],
+            "csv",
+            file_name="hours",
+        )
+    return render_template(
+        "search/hours.html.jinja2",
+        form=form,
+        results=[(user.display_name, total) for user, total in results],
+    )
 
 
 def init_app(app: Flask):
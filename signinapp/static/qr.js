@@ -43,7 +43,9 @@ function populateUsers(userdata) {
 function handleResponse(json) {
     if (json["action"] === "update") {
         populateUsers(json["users"])
-        toast(json["message"])
+        if (json["message"]) {
+            toast(json["message"])
+        }
     } else if (json["action"] === "redirect") {
         window.location.replace("/")
     }
@@ -55,30 +57,142 @@ function updateUserData() {
         .then(handleResponse)
 }
 
+// Scans are queued in IndexedDB and uploaded in batches, so a burst of scans
+// costs one request and nothing is lost while the Wi-Fi is down
+const SCAN_DB = "signin-kiosk"
+const SCAN_STORE = "scans"
+const SCAN_BATCH_SIZE = 100
+const SCAN_RETRY_INTERVAL = 10000
+
+let scanDB = null
+let flushing = false
+
+function openScanDB() {
+    if (!scanDB) {
+        scanDB = new Promise((resolve, reject) => {
+            let request = indexedDB.open(SCAN_DB, 1)
+            request.onupgradeneeded = () => {
+                request.result
+                    .createObjectStore(SCAN_STORE, { keyPath: "scan_id" })
+                    .createIndex("timestamp", "timestamp")
+            }
+            request.onsuccess = () => resolve(request.result)
+            request.onerror = () => reject(request.error)
+        })
+    }
+    return scanDB
+}
+
+function scanTransaction(mode, callback) {
+    return openScanDB().then(db => new Promise((resolve, reject) => {
+        let tx = db.transaction(SCAN_STORE, mode)
+        let result = callback(tx.objectStore(SCAN_STORE))
+        tx.oncomplete = () => resolve(result && result.result)
+        tx.onerror = () => reject(tx.error)
+    }))
+}
+
+function newScanId() {
+    if (window.crypto.randomUUID) {
+        return crypto.randomUUID()
+    }
+    // randomUUID is only available over HTTPS
+    return Array.from(crypto.getRandomValues(new Uint8Array(16)),
+        b => b.toString(16).padStart(2, "0")).join("")
+}
+
+function queueScan(userCode) {
+    return scanTransaction("readwrite", store => store.add({
+        scan_id: newScanId(),
+        user_code: userCode,
+        event_code: event_code,
+        timestamp: Date.now(),
+    }))
+}
+
+function queuedScans() {
+    return scanTransaction("readonly", store => store.index("timestamp").getAll(null, SCAN_BATCH_SIZE))
+}
+
+function forgetScans(scanIds) {
+    return scanTransaction("readwrite", store => scanIds
+        .filter(scanId => typeof scanId === "string")
+        .forEach(scanId => store.delete(scanId)))
+}
+
+// Upload queued scans oldest first until the queue is empty or the server is unreachable
+function flushScans() {
+    if (flushing) {
+        return Promise.resolve()
+    }
+    flushing = true
+    let sent = false
+    const next = () => queuedScans().then(scans => {
+        if (!scans.length) {
+            return
+        }
+        return fetch("/scan/batch", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ scans: scans }),
+        })
+            .then(response => {
+                if (response.status === 400) {
+                    // Sending the same batch again can't succeed, so don't let it block the queue
+                    return response.text().then(data => {
+                        toast(data)
+                        return forgetScans(scans.map(scan => scan.scan_id)).then(() => ({ results: [] }))
+                    })
+                }
+                if (!response.ok) {
+                    return response.text().then(data => { throw new Error(data) })
+                }
+                return response.json()
+            })
+            .then(json => {
+                sent = true
+                json["results"].forEach(result => toast(result["message"]))
+                return forgetScans(json["results"].map(result => result["scan_id"]))
+            })
+            .then(next)
+    })
+    return next()
+        .then(() => { if (sent) { updateUserData() } })
+        .catch(err => console.log(`Scans kept for retry: ${err}`))
+        .finally(() => { flushing = false })
+}
+
 const onScanSuccess = (decodedText) => {
 
     console.log(decodedText)
 
-    let formData = new FormData();
-    formData.append('user_code', decodedText);
-    formData.append('event_code', event_code);
-
-    fetch(`/scan`, { method: "POST", body: formData })
-        .then((response) => {
-            if (response.ok) {
-                return response.json();
-            } else {
-                response.text().then(data => {
-                    toast(data)
-                });
+    queueScan(decodedText.toString()).then(flushScans)
+}
+
+window.addEventListener("online", flushScans)
+setInterval(flushScans, SCAN_RETRY_INTERVAL)
+flushScans()
+
+// Long-poll for changes made by other kiosks, backing off if the server is unreachable
+function waitForUpdates(version) {
+    fetch("/active/wait?" + new URLSearchParams({ event: event_code, version: version || "" }))
+        .then(data => data.json())
+        .then(json => {
+            handleResponse(json)
+            if (json["action"] === "update") {
+                waitForUpdates(json["version"])
             }
         })
-        .then(handleResponse)
+        .catch(() => setTimeout(() => waitForUpdates(version), 5000))
 }
 
-setInterval(updateUserData, 300000)
+if (long_poll) {
+    waitForUpdates()
+} else {
+    setInterval(updateUserData, 300000)
+    updateUserData()
+}
 setInterval(updateTime, 1000)
-updateUserData()
 
 function initCamera() {
     let selectedDeviceId;
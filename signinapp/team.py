@@ -1,21 +1,44 @@
-from collections import defaultdict
+import tempfile
+from collections.abc import Iterator
 from datetime import datetime
+from http import HTTPStatus
 
 import flask_excel as excel
-from flask import Blueprint, Flask, request
+from flask import Blueprint, Flask, Response, request, send_file, stream_with_context
 from flask.templating import render_template
 from flask_login import login_required
+from flask_wtf import FlaskForm
 from sqlalchemy import or_
 from sqlalchemy.future import select
-
-from .model import Role, ShirtSizes, Student, Subteam, User, db
-from .util import admin_required, get_current_graduation_years, mentor_required
+from sqlalchemy.orm import selectinload
+from wtforms import BooleanField, SelectField, SubmitField
+from wtforms.validators import DataRequired
+
+from .database import read_replica
+from .model import Guardian, Role, ShirtSizes, Student, Subteam, User, db, guardian_links
+from .rollup import DIMENSIONS, label, rollup
+from .roster import (
+    GUARDIAN_FIELDS,
+    STUDENT_FIELDS,
+    XLSX_MIMETYPE,
+    csv_lines,
+    roster,
+    write_xlsx,
+    xlsx_available,
+)
+from .util import (
+    MultiCheckboxField,
+    admin_required,
+    get_current_graduation_years,
+    mentor_required,
+)
 
 team = Blueprint("team", __name__)
 
 
 @team.route("/users")
 @mentor_required
+@read_replica
 def users():
     users = User.get_visible_users()
     roles = db.session.scalars(select(Role))
@@ -24,18 +47,58 @@ def users():
 
 @team.route("/shirts")
 @mentor_required
+@read_replica
 def shirts():
-    shirts = defaultdict(lambda: defaultdict(lambda: 0))
-    for size in ShirtSizes:
-        shirts[size]
-    for u in User.get_visible_users():
-        if u.tshirt_size:
-            shirts[u.tshirt_size][u.role] += 1
+    shirts = {size: {} for size in ShirtSizes}
+    for size, role, count in rollup(["shirt", "role"]):
+        if size:
+            shirts[size][role] = count
     return render_template("shirts.html.jinja2", shirts=shirts)
 
 
+class CompositionForm(FlaskForm):
+    by = MultiCheckboxField(
+        "Group by",
+        choices=[(key, name) for key, (name, _) in DIMENSIONS.items()],
+        default=["role"],
+        validators=[DataRequired()],
+    )
+    format = SelectField(choices=[("html", "Table"), ("csv", "CSV")], default="html")
+    submit = SubmitField()
+
+
+@team.route("/team/composition")
+@mentor_required
+@read_replica
+def composition():
+    """Team composition, counted by any combination of DIMENSIONS.
+
+    The grouping comes from query parameters (e.g. ?by=subteam&by=role&format=csv),
+    so a rollup can be bookmarked or downloaded.
+    """
+    form = CompositionForm(formdata=request.args or None, meta={"csrf": False})
+    by = form.by.data if form.validate() else form.by.default
+    headers = [DIMENSIONS[dimension][0] for dimension in by] + ["Users"]
+    rows = [[label(value) for value in row[:-1]] + [row[-1]] for row in rollup(by)]
+
+    if form.format.data == "csv":
+        return excel.make_response_from_array(
+            [headers] + rows,
+            "csv",
+            file_name=f"composition-{datetime.now().strftime('%Y-%m-%d')}.csv",
+        )
+    summaries = {
+        name: [(label(value), count) for value, count in rollup([dimension])]
+        for dimension, (name, _) in DIMENSIONS.items()
+    }
+    return render_template(
+        "composition.html.jinja2", form=form, headers=headers, rows=rows, summaries=summaries
+    )
+
+
 @team.route("/subteam")
 @login_required
+@read_replica
 def subteam():
     st_id = request.args.get("st_id")
     subteam = db.session.get(Subteam, st_id)
@@ -44,6 +107,7 @@ def subteam():
 
 @team.route("/users/students")
 @mentor_required
+@read_replica
 def list_students():
     include_all = request.args.get("include_all", False) == "true"
     select_stmt = select(User).where(or_(User.role.has(name="student"), User.role.has(name="lead")))
@@ -51,32 +115,41 @@ def list_students():
         select_stmt = select_stmt.join(Student).where(
             Student.graduation_year.in_(get_current_graduation_years())
         )
+    select_stmt = select_stmt.options(
+        selectinload(User.student_user_data)
+        .selectinload(Student.guardians)
+        .joinedload(Guardian.user)
+    )
     users = db.session.scalars(select_stmt.order_by(User.name)).all()
     return render_template("user_list.html.jinja2", role="Student", users=users)
 
 
 @team.route("/users/guardians")
 @mentor_required
+@read_replica
 def list_guardians():
     include_all = request.args.get("include_all", False) == "true"
-    users = db.session.scalars(
-        select(User).where(User.role.has(guardian=True)).order_by(User.name)
-    ).all()
+    select_stmt = select(User).where(User.role.has(guardian=True))
     if not include_all:
-        users = [
-            guardian
-            for guardian in users
-            if any(
-                student
-                for student in guardian.guardian_user_data.students
-                if student.graduation_year in get_current_graduation_years()
+        select_stmt = select_stmt.where(
+            User.id.in_(
+                guardian_links(
+                    Student.graduation_year.in_(get_current_graduation_years())
+                ).with_only_columns(Guardian.user_id)
             )
-        ]
+        )
+    select_stmt = select_stmt.options(
+        selectinload(User.guardian_user_data)
+        .selectinload(Guardian.students)
+        .joinedload(Student.user)
+    )
+    users = db.session.scalars(select_stmt.order_by(User.name)).all()
     return render_template("user_list.html.jinja2", role="Guardian", users=users)
 
 
 @team.route("/users/mentors")
 @mentor_required
+@read_replica
 def list_mentors():
     users = db.session.scalars(
         select(User).where(User.role.has(mentor=True)).order_by(User.name)
@@ -84,38 +157,63 @@ def list_mentors():
     return render_template("user_list.html.jinja2", role="Mentor", users=users)
 
 
+def roster_response(rows: Iterator[list], fmt: str, name: str) -> Response:
+    "Send roster rows as a CSV streamed row by row, or as an XLSX workbook"
+    file_name = f"{name}-{datetime.now().strftime('%Y-%m-%d')}.{fmt}"
+    if fmt == "xlsx":
+        if not xlsx_available():
+            return Response("Error: XLSX export needs openpyxl installed", HTTPStatus.BAD_REQUEST)
+        file = tempfile.SpooledTemporaryFile()
+        write_xlsx(rows, file)
+        file.seek(0)
+        return send_file(file, XLSX_MIMETYPE, as_attachment=True, download_name=file_name)
+    return Response(
+        stream_with_context(csv_lines(rows)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={file_name}"},
+    )
+
+
 @team.route("/users/students/export")
 @admin_required
+@read_replica
 def students_export():
-    result = [
-        [
-            "Student Name",
-            "Email",
-            "First Parent Name",
-            "First Parent Email",
-            "Second Parent Name",
-            "Second Parent Email",
-        ]
-    ] + [
-        [
-            student.user.full_name,
-            student.user.email,
-            student.guardians[0].user.name if student.guardians else "",
-            student.guardians[0].user.email if student.guardians else "",
-            student.guardians[1].user.name if len(student.guardians) > 1 else "",
-            student.guardians[1].user.email if len(student.guardians) > 1 else "",
-        ]
-        for student in db.session.scalars(
-            select(Student)
-            .where(Student.graduation_year.in_(get_current_graduation_years()))
-            .order_by(Student.user_id)
-        )
-    ]
-    return excel.make_response_from_array(
-        result,
-        "csv",
-        file_name=f"students-parents-{datetime.now().strftime('%Y-%m-%d')}.csv",
+    rows = roster(["name", "email"], ["name", "email"], guardians=2)
+    return roster_response(rows, "csv", "students-parents")
+
+
+class RosterForm(FlaskForm):
+    fields = MultiCheckboxField(
+        "Student",
+        choices=[(key, header) for key, (header, _) in STUDENT_FIELDS.items()],
+        default=list(STUDENT_FIELDS),
+        validators=[DataRequired()],
     )
+    guardian_fields = MultiCheckboxField(
+        "Each Parent/Guardian",
+        choices=[(key, header) for key, (header, _) in GUARDIAN_FIELDS.items()],
+        default=list(GUARDIAN_FIELDS),
+    )
+    include_all = BooleanField("Include Alumni")
+    format = SelectField(
+        choices=lambda: [("csv", "CSV")] + ([("xlsx", "Excel")] if xlsx_available() else []),
+        default="csv",
+    )
+    submit = SubmitField("Export")
+
+
+@team.route("/users/students/roster", methods=["GET", "POST"])
+@admin_required
+@read_replica
+def students_roster():
+    "Student and guardian contact details, with the columns chosen in the form"
+    form = RosterForm()
+    if form.validate_on_submit():
+        rows = roster(
+            form.fields.data, form.guardian_fields.data, include_all=form.include_all.data
+        )
+        return roster_response(rows, form.format.data, "roster")
+    return render_template("form.html.jinja2", form=form, title="Student Roster")
 
 
 def init_app(app: Flask):
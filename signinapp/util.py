@@ -39,6 +39,15 @@ admin_required = permission_required(lambda u: u.role.admin)
 mentor_required = permission_required(lambda u: u.role.mentor)
 
 
+def running_async() -> bool:
+    "Whether the app is being served by cooperative (gevent) workers"
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
 def correct_time_for_storage(time: datetime) -> datetime:
     # Check if datetime has a tz already:
     if time.tzinfo is None: